@@ -0,0 +1,223 @@
+# Benchmark of the hot paths of the annotation tool, run without a display:
+#   python benchmark.py --output results.json
+#   python benchmark.py --sizes 512 2048 --segments 1 1000 --baseline results.json
+# Synthetic sonar/bathy/tri arrays and annotations are generated in a temporary folder. The time (median and
+# minimum over the repeats) and the peak memory traced by tracemalloc (numpy and Python allocations, not Qt)
+# of each case are printed and written as JSON. With --baseline, cases slower than the baseline by more than
+# the tolerance are reported and the exit status is 1
+import os
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+import io
+import numpy as np
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtCore import QT_VERSION_STR
+import rasterize  # Imported before main, so that it is not a lazy module shared by the save worker
+import main
+
+
+def write_synthetic_tile(folder, prefix, size, seed=0):
+    # Write the three images of a tile by blocks of rows, so that 8k images do not need several copies in memory
+    rng = np.random.default_rng(seed)
+    paths = [os.path.join(folder, f'{prefix}_{modality}.npy') for modality in ('sonar', 'bathy', 'tri')]
+    arrays = [np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(size, size)) for path in paths]
+    x = np.linspace(0, 8 * np.pi, size, dtype=np.float32)
+    block = 1024
+    for start in range(0, size, block):
+        y = np.linspace(0, 8 * np.pi, size, dtype=np.float32)[start:start + block, None]
+        # Sonar: speckle with heavy tails, bathymetry: smooth relief, tri: its roughness
+        arrays[0][start:start + block] = rng.gamma(1.0, 1.0, (len(y), size)).astype(np.float32) ** 2
+        depth = -50 + 10 * np.sin(x) * np.cos(y) + 0.01 * (start + np.arange(len(y), dtype=np.float32))[:, None]
+        arrays[1][start:start + block] = depth
+        arrays[2][start:start + block] = np.abs(np.cos(x) * np.cos(y)) + rng.random((len(y), size), dtype=np.float32) * 0.1
+        if start == 0:
+            arrays[2][0, 0] = np.nan  # Some images have missing values
+    for array in arrays:
+        array.flush()
+    del arrays
+    return paths
+
+
+def synthetic_segments(count, seed=0, points=20):
+    # Random walks in the drawing area, in relative coordinates
+    rng = np.random.default_rng(seed)
+    colors = list(main.CLASS_COLORS.values())
+    starts = rng.uniform(0.41, 0.59, (count, 2))
+    steps = rng.normal(0, 0.002, (count, points, 2))
+    walks = np.clip(starts[:, None, :] + np.cumsum(steps, axis=1), 0.405, 0.595)
+    return [(colors[i % len(colors)], int(rng.choice([1, 3, 5])), [tuple(point) for point in walk.tolist()])
+            for i, walk in enumerate(walks)]
+
+
+def quiet():
+    # The messages of the tool (loaded and saved files) would be mixed with the results
+    return contextlib.redirect_stdout(io.StringIO())
+
+
+def measure(name, function, repeat, setup=None):
+    # Time and peak traced memory of function, the median and minimum over the repeats are kept
+    times = []
+    peak = 0
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        tracemalloc.start()
+        start = time.perf_counter()
+        with quiet():
+            function()
+        times.append(time.perf_counter() - start)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    result = {'median_s': float(np.median(times)), 'min_s': min(times), 'peak_mb': peak / 2 ** 20, 'repeat': repeat}
+    print(f'{name:<32} {result["median_s"] * 1000:10.2f} ms {result["min_s"] * 1000:10.2f} ms {result["peak_mb"]:10.1f} MB', flush=True)
+    return result
+
+
+def benchmark_images(app, folder, size, repeat):
+    results = {}
+    sonar_path = write_synthetic_tile(folder, f'image{size}', size)[0]
+
+    def construct():
+        main._array_cache.clear()  # Measure a cold load of the file
+        widget = main.ImageWidget(sonar_path)
+        widget.deleteLater()
+    results[f'image_widget/{size}'] = measure(f'image_widget/{size}', construct, repeat)
+
+    widget = main.ImageWidget(sonar_path)
+    widget.resize(800, 800)
+    widget.show()
+    app.processEvents()
+    values = iter(range(10 ** 9))
+    results[f'update_image_quantile/{size}'] = measure(f'update_image_quantile/{size}', lambda: widget.update_image_quantile(50 + next(values) % 50), repeat)
+    states = iter(range(10 ** 9))
+    def toggle():
+        widget.log_checkbox.blockSignals(True)
+        widget.log_checkbox.setChecked(next(states) % 2 == 0)
+        widget.log_checkbox.blockSignals(False)
+        widget.toggle_log_transform(widget.log_checkbox.checkState())
+    results[f'toggle_log_transform/{size}'] = measure(f'toggle_log_transform/{size}', toggle, repeat)
+    widget.close()
+    widget.deleteLater()
+    app.processEvents()
+    return results
+
+
+def benchmark_annotations(app, folder, counts, repeat):
+    results = {}
+    sonar, bathy, tri = write_synthetic_tile(folder, 'annotated', 512)
+    output_folder = os.path.join(folder, 'output')
+    os.makedirs(output_folder, exist_ok=True)
+    with quiet():
+        window = main.MainWindow(sonar, bathy, tri, output_folder, 'annotated')
+    main.main_window = window
+    window.resize(1800, 900)
+    window.show()
+    app.processEvents()
+    canvas = window.image_widget1.canvas
+    for count in counts:
+        segments = synthetic_segments(count)
+        window.annotations.set_segments(list(segments))
+        app.processEvents()
+        # Full paint: the layer of the finished strokes is redrawn, cached paint: only the layer is copied
+        results[f'paint/full/{count}'] = measure(f'paint/full/{count}', canvas.repaint, repeat, setup=canvas.invalidate_layer)
+        results[f'paint/cached/{count}'] = measure(f'paint/cached/{count}', canvas.repaint, repeat)
+
+        # Erase: a stroke is removed and the three canvases repaint its area, the setup puts it back by undo
+        canvases = [widget.canvas for widget in (window.image_widget1, window.image_widget2, window.image_widget3)]
+        def erase():
+            window.annotations.remove_segments([window.annotations.ids[count // 2]])
+            for erased_canvas in canvases:
+                erased_canvas.repaint()
+        def put_back():
+            window.annotations.undo()
+            for erased_canvas in canvases:
+                erased_canvas.repaint()
+        results[f'erase/{count}'] = measure(f'erase/{count}', erase, repeat, setup=put_back)
+        put_back()
+
+        def save():
+            window.save()
+            window.flush_saves()
+        results[f'save/{count}'] = measure(f'save/{count}', save, repeat)
+        with quiet():
+            app.processEvents()  # Deliver the end of the saves
+        results[f'load/{count}'] = measure(f'load/{count}', window.load, repeat)
+        if len(window.segments) != count:
+            raise RuntimeError(f'{len(window.segments)} segments loaded instead of {count}')
+    window.close()
+    window.deleteLater()
+    app.processEvents()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # Cases slower than the baseline by more than the tolerance, as (name, ratio)
+    regressions = []
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if reference is None or reference['median_s'] <= 0:
+            continue
+        ratio = result['median_s'] / reference['median_s']
+        marker = '  REGRESSION' if ratio > 1 + tolerance else ''
+        print(f'{name:<32} {ratio:8.2f}x{marker}')
+        if marker:
+            regressions.append((name, ratio))
+    return regressions
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description='Benchmark of the image annotation tool')
+    parser.add_argument('--sizes', type=int, nargs='*', default=[512, 2048, 8192], help='sizes of the synthetic images (default: %(default)s)')
+    parser.add_argument('--segments', type=int, nargs='*', default=[1, 1000, 100000], help='numbers of synthetic segments (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each case (default: %(default)s)')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare the results to this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='slowdown reported as a regression (default: %(default)s)')
+    args = parser.parse_args()
+
+    app = QApplication(sys.argv[:1])
+    folder = tempfile.mkdtemp(prefix='annotation-benchmark-')
+    results = {}
+    print(f'{"case":<32} {"median":>13} {"min":>13} {"peak":>13}')
+    try:
+        for size in args.sizes:
+            results.update(benchmark_images(app, folder, size, args.repeat))
+        if args.segments:
+            results.update(benchmark_annotations(app, folder, args.segments, args.repeat))
+    finally:
+        main.main_window = None
+        shutil.rmtree(folder, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'qt': QT_VERSION_STR,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        print('\nCompared to', args.baseline)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f'{len(regressions)} regression(s) above {args.tolerance:.0%}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main_benchmark()
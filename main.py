@@ -1,61 +1,177 @@
-import numpy as np
+import time
+_startup_time = time.perf_counter()  # Reference of the --startup-profile phases
 import sys
 import os
+import math
+import importlib.util
+
+def lazy_import(name):
+    # Module executed on its first attribute access, so that the folder selection window does not wait for it
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+np = lazy_import('numpy')
+rasterize = lazy_import('rasterize')  # Label matrices of the annotations, without Qt
 import json
-from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QLabel, QPushButton, QVBoxLayout, QHBoxLayout, QTabWidget,QSizePolicy,QDialog,QFileDialog,QColorDialog,QInputDialog,QSlider,QCheckBox
-from PyQt5.QtGui import QPixmap
-from PyQt5.QtCore import Qt, QFileInfo,QPoint,QRect,QSize
-from PyQt5.QtGui import QImage
-from PyQt5.QtGui import QPen, QPainter, QColor, QPainterPath
-from matplotlib import cm
-from skimage.draw import line    
+import re
+import tempfile
+import zipfile
+import argparse
+import hashlib
+import bisect
+import threading
+import functools
+import contextlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from PyQt5.QtWidgets import QApplication, QWidget, QLabel, QPushButton, QVBoxLayout, QHBoxLayout, QTabWidget,QSizePolicy,QFileDialog,QInputDialog,QSlider,QCheckBox,QMessageBox,QComboBox,QShortcut
+from PyQt5.QtGui import QPixmap, QKeySequence
+from PyQt5.QtCore import Qt, QFileInfo,QPointF,QRect,QRectF,QObject,QTimer,pyqtSignal
+from PyQt5.QtGui import QImage, QImageReader
+from PyQt5.QtGui import QPen, QPainter, QColor, QPolygonF, QRegion
+
+# Annotation classes and the pencil color used to draw them
+CLASS_COLORS = {'Posidonie': '#0b9224', 'Enrochement': '#969d97', 'Matte': '#d55e09', 'Anthropique': '#0c03d2', 'Cymodecee': '#20e4db', 'Sediment' : '#fef22f', 'Roche' : '#751f1c', 'BlocGaletGravier' : '#524e44', 'SedimentRide' : '#a28446'}
+# Value written in the label matrix for each pencil color (0 is not annotated)
+CLASS_LABELS = {color: label for label, color in enumerate(CLASS_COLORS.values(), start=1)}
+# Overlap priority of the regions of each pencil color, the higher covers the lower and equal priorities are drawn in
+# order: the built structures and the seagrass cover the seabed types. The strokes are always drawn over the regions.
+# The "class_priority" setting of a dataset changes it (see DATASET_CONFIG)
+CLASS_PRIORITY = {CLASS_COLORS[name]: priority for priority, name in enumerate(['Sediment', 'SedimentRide', 'BlocGaletGravier', 'Roche', 'Matte', 'Cymodecee', 'Posidonie', 'Enrochement', 'Anthropique'])}
+# Format of the saved annotations: 'json', or 'npz' (compact binary, faster to load) with --annotation-format npz
+ANNOTATION_FORMAT = 'json'
+# Optional settings of a folder of images, read from this JSON file in the folder:
+#   "drawing_area": the window that is annotated and exported, in pixels of the tiles. {"size": 150} is a square of
+#       150 pixels in the middle of the tiles, {"fraction": 0.2} a square of a fraction of their width and
+#       {"rows": [start, stop], "cols": [start, stop]} an explicit window (stop excluded). The default is the historical
+#       square of 100 pixels with its border lines, 101 pixels wide
+#   "mosaic": where the tiles go in the survey array written by --mosaic. "offsets" gives the (row, column) of the
+#       first pixel of each tile by prefix, otherwise "pattern" is a regular expression with "row" and "col" groups
+#       matched in the prefix and multiplied by "step" ([rows, columns]). Only the drawing areas are written, and the
+#       array starts at the first of them. "shape" is the size of the array, by default it just covers the tiles
+#   "class_priority": overlap priority of the regions by class name, e.g. {"Matte": 10}, replacing those of CLASS_PRIORITY
+DATASET_CONFIG = 'annotation_config.json'
+# Percentiles of every modality over all the tiles of a folder of images, for the global normalization (see --statistics)
+DATASET_STATISTICS = '.annotation_statistics.json'
+# Strokes are simplified to this distance in image pixels while drawing, 0 keeps every mouse event
+SIMPLIFY_TOLERANCE = 1.0
+SIMPLIFY_ON_LOAD = False  # Also simplify the annotations loaded from disk
+# Interval in milliseconds between two writes of the annotation journal to disk
+JOURNAL_SYNC_INTERVAL = 1000
+# Reach of the eraser and of a selection click around the cursor, in screen pixels
+ERASER_RADIUS = 6
+SELECT_RADIUS = 4
+# Zoom factor of one step of the mouse wheel, and largest zoom of the views (1 shows the whole image)
+ZOOM_STEP = 1.25
+MAX_ZOOM = 64
+# Interval in milliseconds between two refreshes of the coverage panel while drawing
+COVERAGE_REFRESH = 100
+
+class Tracer:
+    # Spans of the hot paths, recorded as Chrome trace events (chrome://tracing, Perfetto) and summed up for
+    # the status overlay. When neither is on, a span costs one attribute test
+    MAX_EVENTS = 1 << 20  # The oldest events are dropped beyond
+
+    def __init__(self):
+        self.enabled = False
+        self.recording = False
+        self.overlay = False
+        self.events = deque(maxlen=self.MAX_EVENTS)  # (name, start, duration, thread id), in seconds
+        self.totals = {}  # Name -> [count, total duration] since the overlay last read them
+        self._lock = threading.Lock()
+
+    def set_recording(self, recording):
+        if recording and not self.recording:
+            self.events.clear()
+        self.recording = recording
+        self.enabled = self.recording or self.overlay
+
+    def set_overlay(self, overlay):
+        self.overlay = overlay
+        self.enabled = self.recording or self.overlay
+
+    def span(self, name):
+        return _Span(name) if self.enabled else _no_span
+
+    def record(self, name, start, end):
+        if self.recording:
+            self.events.append((name, start, end - start, threading.get_ident()))
+        if self.overlay:
+            with self._lock:
+                total = self.totals.setdefault(name, [0, 0.0])
+                total[0] += 1
+                total[1] += end - start
+
+    def take_totals(self):
+        with self._lock:
+            totals, self.totals = self.totals, {}
+        return totals
+
+    def dump(self, path):
+        # Chrome trace_event format, with times in microseconds since the start of the process
+        events = [{'name': name, 'ph': 'X', 'ts': round((start - _startup_time) * 1e6, 1), 'dur': round(duration * 1e6, 1),
+                   'pid': os.getpid(), 'tid': thread} for name, start, duration, thread in list(self.events)]
+        trace = {'traceEvents': events, 'displayTimeUnit': 'ms'}
+        write_atomic(path, lambda f: f.write(json.dumps(trace).encode()))
+        print(f'Trace of {len(events)} spans written to {path}')
+
+class _Span:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        tracer.record(self.name, self.start, time.perf_counter())
+
+_no_span = contextlib.nullcontext()
+tracer = Tracer()
+# A session is traced from the start when ANNOTATION_TRACE names the file to write at the end
+if os.environ.get('ANNOTATION_TRACE'):
+    tracer.set_recording(True)
+
+def traced(name):
+    # Record the calls of a function as spans. Not for Qt slots: the wrapper hides how many arguments they take
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                tracer.record(name, start, time.perf_counter())
+        return wrapper
+    return decorate
+
 
 class ImageWidget(QWidget):
-    def __init__(self, image_path, parent=None):
+    PREVIEW_LEVELS = 2  # While a slider is dragged, the image is rendered at 1/4 of the resolution of the display
+    REFINE_DELAY = 200  # ms without slider movement before the full resolution render
+    VIEW_MARGIN = 0.5  # When zoomed, the render covers this fraction of the view around it, panning within only redraws
+
+    def __init__(self, image_path, parent=None, image=None):
         super().__init__(parent)
-        self.image_path = image_path
         self.image_label = QLabel(self)
+        self.image_label.setAlignment(Qt.AlignCenter)  # The canvas expects the image in the middle of the label
         self.opacity = 255
-        
-        if self.image_path.lower().endswith('.npy'):
-            image_data = np.load(image_path)
-
-            if len(image_data.shape) == 2:
-                # Normalize the image to span the full colormap
-                image_data = (image_data - np.min(image_data)) / (np.max(image_data) - np.min(image_data))
-                image_data=add_border(image_data)
-                # Get the colormap
-                cmap = cm.get_cmap('gray')
-                # Apply the colormap
-                rgba_image = cmap(image_data)
-                # Convert the data to 0-255 integers
-                image_data = (rgba_image * 255).astype(np.uint8)
-
-                height, width, _ = image_data.shape
-                bytes_per_line = 4 * width  # for Format_RGBA8888, each pixel is 4 bytes
-               
-                qimage = QImage(image_data.data, width, height, bytes_per_line, QImage.Format_RGBA8888)
-
-            elif len(image_data.shape) == 3:
-                if image_data.shape[2] == 3 or image_data.shape[2] == 4:
-                    image_data = image_data[..., ::-1]  # reverse the color channels
-
-                image_data = np.require(image_data, np.uint8, 'C')
-                height, width, channels = image_data.shape
-                bytes_per_line = channels * width
-                qimage = QImage(image_data.data, width, height, bytes_per_line, QImage.Format_RGB888)
-
-            else:
-                raise ValueError(f"Unsupported number of dimensions: {len(image_data.shape)}")
-
-            self.pixmap = QPixmap.fromImage(qimage)
-            self.image_label.setPixmap(self.pixmap)
-        else:
-            pixmap = QPixmap(image_path)
-
-        pixmap = QPixmap.fromImage(qimage)
-        scaled_pixmap = pixmap.scaled(512, 512, Qt.KeepAspectRatio)
-        self.image_label.setPixmap(scaled_pixmap)
+        self._display_level = None  # Pyramid level of the current pixmap
+        # Zoom and center (relative image coordinates) of the view, shared by the three images (see MainWindow.set_view)
+        self.zoom = 1
+        self.center = (0.5, 0.5)
+        self._pixmap_region = None  # (level, rows, columns) of the full resolution image rendered into the pixmap
+        self._pan_start = None  # (position, center) when the view is dragged
 
         self.canvas = CanvasWidget(self)
         self.canvas.hide()  # Hide initially
@@ -91,9 +207,83 @@ class ImageWidget(QWidget):
         # Add the log transform checkbox to the layout
         self.layout.addWidget(self.log_checkbox)
 
-        # Load the image data and store a copy for transformations
-        self.original_image_data = np.load(self.image_path)
-        self.transformed_image_data = np.copy(self.original_image_data)
+        # Normalize with the percentiles of the whole dataset instead of those of the tile, once they are computed
+        self.global_checkbox = QCheckBox('Global Normalization', self)
+        self.global_checkbox.stateChanged.connect(self.update_image)
+        self.layout.addWidget(self.global_checkbox)
+
+        # Gamma of the display, in hundredths
+        self.gamma_slider = QSlider(Qt.Horizontal, self)
+        self.gamma_slider.setRange(10, 300)
+        self.gamma_slider.setValue(100)
+        self.gamma_slider.valueChanged.connect(self.update_image)
+        self.layout.addWidget(self.gamma_slider)
+
+        # Palette of single band images
+        self.colormap_combo = QComboBox(self)
+        self.colormap_combo.addItems(list(COLORMAPS.keys()))
+        self.colormap_combo.currentTextChanged.connect(self.update_image)
+        self.layout.addWidget(self.colormap_combo)
+        self._image_buffer = None  # Reused by the renderings of the same size
+        self._border_color = Qt.white
+
+        # While a display slider is dragged only the latest value is rendered, as a preview, and the display level
+        # is rendered in a worker thread when the slider is released or rests
+        self._preview_timer = QTimer(self)
+        self._preview_timer.setSingleShot(True)
+        self._preview_timer.timeout.connect(self.render_preview)
+        self._refine_timer = QTimer(self)
+        self._refine_timer.setSingleShot(True)
+        self._refine_timer.setInterval(self.REFINE_DELAY)
+        self._refine_timer.timeout.connect(self.refine)
+        self.quantile_slider.sliderReleased.connect(self.refine)
+        self.gamma_slider.sliderReleased.connect(self.refine)
+        self.render_signals = RenderSignals(self)
+        self.render_signals.rendered.connect(self._refined)
+        self.render_executor = None  # Started by the first refinement
+        self._render_generation = 0  # Renders started before the last change are dropped
+
+        # The image can be prepared beforehand (see TilePrefetcher), otherwise it is loaded now
+        self.set_image(image if image is not None else ImageData(image_path))
+        # The first pixmap sets the size of the label
+        self.image_label.setPixmap(self.pixmap.scaled(512, 512, Qt.KeepAspectRatio))
+
+    def set_image(self, image):
+        # Display another image, image is an ImageData
+        self.image_path = image.path
+        self.stats = image.stats  # Quantile index of the image, only for single band images
+        self.pyramid = image.pyramid  # Downsamples of the image, only for single band images
+        self.display = DisplayPipeline(self.stats, image.global_percentiles) if self.stats is not None else None
+        self.global_checkbox.setEnabled(image.global_percentiles is not None)
+        self._preview_timer.stop()
+        self._refine_timer.stop()
+        self._render_generation += 1  # Drop the renders of the previous image
+        self._display_level = None
+        # Keep a read-only view of the cached image data
+        self.original_image_data = image.data
+        self.image_shape = image.shape  # (height, width) of the data
+        self.drawing_area = image.drawing_area  # (rows, columns) of the data that are annotated
+        self.class_priority = image.class_priority
+
+        if self.stats is not None:
+            # Single band images are normalized with the quantile index, like when the sliders move
+            self.update_image()
+        else:
+            if image.data is not None:
+                image_data = image.data
+                if image_data.shape[2] == 3 or image_data.shape[2] == 4:
+                    image_data = image_data[..., ::-1]  # reverse the color channels
+
+                image_data = np.require(image_data, np.uint8, 'C')
+                height, width, channels = image_data.shape
+                bytes_per_line = channels * width
+                qimage = QImage(image_data.data, width, height, bytes_per_line, QImage.Format_RGB888)
+                self.pixmap = QPixmap.fromImage(qimage)
+            else:
+                self.pixmap = QPixmap(image.path)
+            self._pixmap_region = (0, slice(0, self.image_shape[0]), slice(0, self.image_shape[1]))
+            self.update_image_label_pixmap()
+        self.canvas.invalidate_layer()
 
                 
     def set_opacity(self, value):
@@ -109,8 +299,7 @@ class ImageWidget(QWidget):
     def resizeEvent(self, event):
         super().resizeEvent(event)
         # Scale pixmap to fit the label
-        scaled_pixmap = self.pixmap.scaled(self.image_label.width(), self.image_label.height(), Qt.KeepAspectRatio)
-        self.image_label.setPixmap(scaled_pixmap)
+        self.update_image_label_pixmap()
         # Adjust canvas size to image_label size
         self.canvas.setGeometry(self.image_label.geometry())
         self.canvas.update() 
@@ -130,82 +319,652 @@ class ImageWidget(QWidget):
         
             
     def update_image_label_pixmap(self):
-        scaled_pixmap = self.pixmap.scaled(self.image_label.width(), self.image_label.height(), Qt.KeepAspectRatio)
-        self.image_label.setPixmap(scaled_pixmap)
-   
-    def update_image_quantile(self, value):
-        # Convert the value from a 0-100 scale to a 0.0-1.0 scale
-        quantile = value / 100.0
-        if self.image_path.lower().endswith('.npy'):
-            image_data = np.load(self.image_path)
-            
-            # Rescale the image data to the specified quantile
-            min_value = np.percentile(image_data, 0)
-            max_value = np.percentile(image_data, quantile*100)
-            image_data = np.clip(image_data, min_value, max_value)
-            
-            # Normalize the image to span the full colormap
-            image_data = (image_data - np.min(image_data)) / (np.max(image_data) - np.min(image_data))
+        width, height = self.display_size()
+        if self.pyramid is not None and (self.pyramid.level_for(*self.zoomed_size()) != self._display_level or not self._pixmap_covers_view()):
+            # Another level of the pyramid matches the new size or zoom better, or the view left the rendered region
+            level = self.pyramid.level_for(*self.zoomed_size())
+            if self.pyramid.levels[level] is None and self.stats is not None and not (self.quantile_slider.isSliderDown() or self.gamma_slider.isSliderDown()):
+                # The level is decoded from the data in the worker thread, the first level kept is shown meanwhile
+                self.render_preview(next(index for index in range(level, len(self.pyramid.levels)) if self.pyramid.levels[index] is not None))
+                self.refine()
+            else:
+                self.update_image()
+            return
+        with tracer.span('ImageWidget.scale_pixmap'):
+            # Mapping from relative image coordinates to the scaled pixmap, which has the place of the whole image
+            # in the label at zoom 1
+            scale_x, scale_y = width * self.zoom, height * self.zoom
+            transform = (scale_x, scale_y, width / 2 - self.center[0] * scale_x, height / 2 - self.center[1] * scale_y)
+            if self.zoom == 1:
+                # The pixmap is stretched to the aspect ratio of the full resolution image
+                scaled_pixmap = self.pixmap.scaled(width, height, Qt.IgnoreAspectRatio)
+            else:
+                # Only the visible part of the rendered region is drawn, at its place in the view
+                level, rows, cols = self._pixmap_region
+                image_height, image_width = self.image_shape
+                scaled_pixmap = QPixmap(width, height)
+                scaled_pixmap.fill(Qt.black)
+                painter = QPainter(scaled_pixmap)
+                painter.drawPixmap(QRectF(cols.start / image_width * scale_x + transform[2], rows.start / image_height * scale_y + transform[3],
+                                          (self.pixmap.width() << level) / image_width * scale_x, (self.pixmap.height() << level) / image_height * scale_y),
+                                   self.pixmap, QRectF(self.pixmap.rect()))
+                painter.end()
+            if self.stats is not None:
+                self.draw_border_overlay(scaled_pixmap, transform)
+            self.image_label.setPixmap(scaled_pixmap)
+
+    def draw_border_overlay(self, pixmap, transform):
+        # Frame the drawing area on the scaled pixmap, white on dark images and black on bright ones, the image data
+        # itself is left untouched. The frame is on the first and last rows and columns of the area
+        scale_x, scale_y, offset_x, offset_y = transform
+        scale_x, scale_y = scale_x / self.image_shape[1], scale_y / self.image_shape[0]
+        rows, cols = self.drawing_area
+        painter = QPainter(pixmap)
+        painter.setPen(QPen(self._border_color, 0))
+        painter.drawRect(QRectF(cols.start * scale_x + offset_x, rows.start * scale_y + offset_y, (cols.stop - 1 - cols.start) * scale_x, (rows.stop - 1 - rows.start) * scale_y))
+        painter.end()
+
+    def display_size(self):
+        # Size of the image in the label, keeping the aspect ratio of the data
+        height, width = self.image_shape
+        scale_factor = min(self.image_label.width() / width, self.image_label.height() / height)
+        return max(round(width * scale_factor), 1), max(round(height * scale_factor), 1)
+
+    def zoomed_size(self):
+        # Size of the whole image at the zoom of the view
+        width, height = self.display_size()
+        return round(width * self.zoom), round(height * self.zoom)
+
+    def view_transform(self):
+        # Mapping from relative image coordinates to label coordinates: label = relative * scale + offset. At zoom 1 the
+        # image fits the label and is centered, when zoomed the view keeps that place
+        height, width = self.image_shape
+        scale_factor = min(self.image_label.width() / width, self.image_label.height() / height)
+        fit_width, fit_height = scale_factor * width, scale_factor * height
+        scale_x, scale_y = fit_width * self.zoom, fit_height * self.zoom
+        return (scale_x, scale_y, (self.image_label.width() - fit_width) / 2 + fit_width / 2 - self.center[0] * scale_x,
+                (self.image_label.height() - fit_height) / 2 + fit_height / 2 - self.center[1] * scale_y)
+
+    def viewport(self):
+        # Rectangle of the label where the image is shown
+        height, width = self.image_shape
+        scale_factor = min(self.image_label.width() / width, self.image_label.height() / height)
+        fit_width, fit_height = scale_factor * width, scale_factor * height
+        return QRectF((self.image_label.width() - fit_width) / 2, (self.image_label.height() - fit_height) / 2, fit_width, fit_height)
+
+    def set_view(self, zoom, center):
+        self.zoom, self.center = zoom, center
+        self.update_image_label_pixmap()
+        self.canvas.update()
 
-            image_data=add_border(image_data)
-            # Convert the image data to 8-bits and reshape it to 1D
-            image_8bit = np.uint8(image_data * 255).reshape(-1)
+    def _view_region(self, level, margin):
+        # Full resolution rows and columns of the view, with a margin (fraction of the view) on every side, on the
+        # pixels of the level
+        reach = (0.5 + margin) / self.zoom
+        region = []
+        for center, size in zip(self.center[::-1], self.image_shape):
+            first = max(int(np.floor((center - reach) * size)), 0) >> level << level
+            stop = min(-(-int(np.ceil((center + reach) * size)) >> level) << level, size)
+            region.append(slice(first, stop))
+        return tuple(region)
+
+    def _pixmap_covers_view(self):
+        if self._pixmap_region is None:
+            return False
+        _, rows, cols = self._pixmap_region
+        view_rows, view_cols = self._view_region(0, 0)
+        return rows.start <= view_rows.start and view_rows.stop <= rows.stop and cols.start <= view_cols.start and view_cols.stop <= cols.stop
+
+    def wheelEvent(self, event):
+        # The wheel zooms the three views around the point under the cursor
+        steps = event.angleDelta().y() / 120
+        if steps:
+            scale_x, scale_y, offset_x, offset_y = self.view_transform()
+            pos = event.pos() - self.image_label.pos()
+            main_window.zoom_view(ZOOM_STEP ** steps, ((pos.x() - offset_x) / scale_x, (pos.y() - offset_y) / scale_y))
 
-            # Create QImage from the data
-            height, width = image_data.shape
-            qimage = QImage(image_8bit.data, width, height, QImage.Format_Grayscale8)
+    def mousePressEvent(self, event):
+        # The views are dragged with the middle button, the canvas passes it on
+        if event.button() == Qt.MiddleButton:
+            self._pan_start = (event.pos(), self.center)
+        else:
+            super().mousePressEvent(event)
 
-            # Set the new pixmap
-            self.pixmap = QPixmap.fromImage(qimage)
-            self.update_image_label_pixmap()
+    def mouseMoveEvent(self, event):
+        if self._pan_start is not None:
+            (start, center), (scale_x, scale_y, _, _) = self._pan_start, self.view_transform()
+            main_window.set_view(main_window.view_zoom, (center[0] - (event.pos().x() - start.x()) / scale_x, center[1] - (event.pos().y() - start.y()) / scale_y))
+        else:
+            super().mouseMoveEvent(event)
 
-    def toggle_log_transform(self, state):
-        if state == Qt.Checked:
-            # Apply a log transform to the data, adding a small constant to avoid log(0)
-            self.transformed_image_data = np.log(self.original_image_data + 1e-9)
+    def mouseReleaseEvent(self, event):
+        if event.button() == Qt.MiddleButton:
+            self._pan_start = None
         else:
-            # If the checkbox is unchecked, use the original image data
-            self.transformed_image_data = np.copy(self.original_image_data)
+            super().mouseReleaseEvent(event)
+   
+    def update_image_quantile(self, value):
+        # The quantile is read from the slider, the other stages of the display pipeline are cached
+        self.update_image()
 
+    def toggle_log_transform(self, state):
+        # Only the stages of the display pipeline after the log are recomputed, on the bins of the quantile index
         self.update_image()
 
     def update_image(self):
-        # Convert the value from a 0-100 scale to a 0.0-1.0 scale
-        quantile = self.quantile_slider.value() / 100.0
-
-        # Rescale the image data to the specified quantile
-        image_data = self.transformed_image_data
-        min_value = np.percentile(image_data, 0)
-        max_value = np.percentile(image_data, quantile*100)
-        image_data = np.clip(image_data, min_value, max_value)
-        
-        # Normalize the image to span the full colormap
-        image_data = (image_data - np.min(image_data)) / (np.max(image_data) - np.min(image_data))
-        image_data=add_border(image_data)
-        # Convert the image data to a QImage
-        image_data = np.uint8(image_data * 255)  # Convert to 8-bit unsigned integer
-        qimage = QImage(image_data.data, image_data.shape[1], image_data.shape[0], image_data.strides[0], QImage.Format_Grayscale8)
+        if self.stats is None:
+            return
+        if self.quantile_slider.isSliderDown() or self.gamma_slider.isSliderDown():
+            # Coalesce the values of the drag: the preview is rendered once the pending events are processed
+            self._preview_timer.start()
+            self._refine_timer.start()
+            return
+
+        with tracer.span('ImageWidget.update_image'):
+            # Only the pyramid level that matches the size of the label at the zoom is rendered, in the region of the view
+            self._display_level = self.pyramid.level_for(*self.zoomed_size())
+            rows, cols = self._view_region(self._display_level, self.VIEW_MARGIN)
+            self.set_display_params()
+            self._render_generation += 1
+            self._image_buffer = self.pyramid.render(self._display_level, self.display.lut(), rows, cols, out=self._image_buffer)
+            self.set_rendering(self._image_buffer, self._display_level, rows, cols)
+        self.update_image_label_pixmap()    
 
-        
+    def render_preview(self, level=None):
+        # Render a coarser level than the display, PREVIEW_LEVELS above by default, it is stretched to the label until
+        # refine replaces it
+        with tracer.span('ImageWidget.render_preview'):
+            self._display_level = self.pyramid.level_for(*self.zoomed_size())
+            level = level if level is not None else min(self._display_level + self.PREVIEW_LEVELS, len(self.pyramid.levels) - 1)
+            rows, cols = self._view_region(level, self.VIEW_MARGIN)
+            self.set_display_params()
+            self._render_generation += 1
+            self._image_buffer = self.pyramid.render(level, self.display.lut(), rows, cols, out=self._image_buffer)
+            self.set_rendering(self._image_buffer, level, rows, cols)
+        self.update_image_label_pixmap()
+
+    def refine(self):
+        # Render the display level with the latest slider values in the worker thread
+        if self.stats is None:
+            return
+        self._preview_timer.stop()
+        self._refine_timer.stop()
+        self._display_level = self.pyramid.level_for(*self.zoomed_size())
+        rows, cols = self._view_region(self._display_level, self.VIEW_MARGIN)
+        self.set_display_params()
+        self._render_generation += 1
+        generation = self._render_generation
+        if self.render_executor is None:
+            self.render_executor = ThreadPoolExecutor(max_workers=1)
+        future = self.render_executor.submit(self.pyramid.render, self._display_level, self.display.lut(), rows, cols)
+        future.region = (self._display_level, rows, cols)
+        future.add_done_callback(lambda future: self.render_signals.rendered.emit(generation, future))
+
+    def _refined(self, generation, future):
+        # Runs in the GUI thread, the render is shown unless the display changed since it started
+        if generation == self._render_generation:
+            self.set_rendering(future.result(), *future.region)
+            self.update_image_label_pixmap()
+
+    def set_display_params(self):
+        # Log, clip to the 0th..slider quantile, gamma, normalize and color with a single LUT over the bins
+        self.display.set(log=self.log_checkbox.isChecked(), quantile=self.quantile_slider.value(),
+                         normalization='global' if self.global_checkbox.isChecked() else 'tile',
+                         gamma=self.gamma_slider.value() / 100, colormap=self.colormap_combo.currentText())
+
+    def set_rendering(self, image_data, level, rows, cols):
+        # Convert the render of a region of a level to a QImage, the buffer is wrapped without copy
+        self._pixmap_region = (level, rows, cols)
+        if image_data.ndim == 2:
+            qimage = QImage(image_data.data, image_data.shape[1], image_data.shape[0], image_data.strides[0], QImage.Format_Grayscale8)
+        else:
+            qimage = QImage(image_data.data, image_data.shape[1], image_data.shape[0], image_data.strides[0], QImage.Format_RGBA8888)
         # Set the new pixmap
         self.pixmap = QPixmap.fromImage(qimage)
-        self.update_image_label_pixmap()    
+        self._border_color = Qt.white if self.display.mean(self.pyramid.histogram()) < 128 else Qt.black
         
         
+class CoverageCounter:
+    # Labels of the drawing area and number of pixels of every label, kept up to date by the changes of the
+    # annotations. The strokes and the regions are rasterized into two layers, the strokes covering the regions, so
+    # that a change only rasterizes again the box it covers in its own layer, from the segments of that layer
+    # crossing the box. A stroke drawn on top of the others only needs its own new pieces. The regions changed
+    # since the last flush (e.g. the outline being drawn with the fill tool) are rasterized once, by flush
+    def __init__(self, shape, window, class_priority=CLASS_PRIORITY):
+        self.shape = shape[:2]
+        self.class_priority = class_priority
+        height, width = self.shape
+        rows, cols = window
+        self.rows, self.cols = slice(*rows.indices(height)[:2]), slice(*cols.indices(width)[:2])
+        size = (max(self.rows.stop - self.rows.start, 0), max(self.cols.stop - self.cols.start, 0))
+        self._labels = np.zeros(size, dtype=np.uint8)
+        self._layers = {False: np.zeros(size, dtype=np.uint8), True: np.zeros(size, dtype=np.uint8)}  # Strokes, regions
+        self.area = self._labels.size  # Pixels of the drawing area
+        self._counts = np.zeros(len(CLASS_LABELS) + 1, dtype=np.int64)  # Pixels of every label, 0 for none
+        self._counts[0] = self.area
+        self._segments = {}  # Id -> segment, for the segments crossing the drawing area
+        # Id -> (first row, end row, first column, end column) of the pixels each segment may cover, by layer
+        self._boxes = {False: {}, True: {}}
+        self._reset = None  # (ids, segments) not rasterized yet
+        self._dirty = []  # Boxes of the regions changed since the last flush
+
+    @property
+    def labels(self):
+        self.flush()
+        return self._labels
+
+    @property
+    def counts(self):
+        self.flush()
+        return self._counts
+
+    def reset(self, ids, segments):
+        # The whole drawing area is rasterized when it is next needed, so that a loaded tile is shown first
+        self._reset = (list(ids), list(segments))
+        self._dirty = []
+
+    def flush(self):
+        self._rasterize_reset()
+        if self._dirty:
+            boxes, self._dirty = self._dirty, []
+            self._recompute(True, boxes)
+
+    def _rasterize_reset(self):
+        if self._reset is None:
+            return
+        ids, segments = self._reset
+        self._reset = None
+        # The boxes of all the segments at once
+        lengths = np.array([len(points) for _, _, points in segments], dtype=np.int64)
+        kept = np.flatnonzero(lengths)
+        points = np.array([point for _, _, points in segments for point in points], dtype=np.float64).reshape(-1, 2)
+        height, width = self.shape
+        points = points * (width, height) - 0.5
+        starts = (np.cumsum(lengths) - lengths)[kept]
+        reach = np.ceil(np.maximum([segments[index][1] for index in kept], 1) / 2).astype(np.int64) + 1
+        first_rows = np.maximum(np.floor(np.minimum.reduceat(points[:, 1], starts)).astype(np.int64) - reach, self.rows.start) if kept.size else kept
+        end_rows = np.minimum(np.ceil(np.maximum.reduceat(points[:, 1], starts)).astype(np.int64) + reach + 1, self.rows.stop) if kept.size else kept
+        first_cols = np.maximum(np.floor(np.minimum.reduceat(points[:, 0], starts)).astype(np.int64) - reach, self.cols.start) if kept.size else kept
+        end_cols = np.minimum(np.ceil(np.maximum.reduceat(points[:, 0], starts)).astype(np.int64) + reach + 1, self.cols.stop) if kept.size else kept
+        inside = (first_rows < end_rows) & (first_cols < end_cols)
+        boxes = np.stack([first_rows, end_rows, first_cols, end_cols], axis=1)[inside].tolist()
+        kept = kept[inside].tolist()
+        self._segments = {ids[index]: segments[index] for index in kept}
+        self._boxes = {False: {}, True: {}}
+        for index, box in zip(kept, boxes):
+            self._boxes[segments[index][1] == rasterize.FILL_THICKNESS][ids[index]] = tuple(box)
+        window = (self.rows.start, self.rows.stop, self.cols.start, self.cols.stop)
+        for region in (False, True):
+            self._set(region, window, rasterize.rasterize_segments([self._segments[segment_id] for segment_id in self._boxes[region]], self.shape, CLASS_LABELS, self.class_priority, window=(self.rows, self.cols)))
+
+    def update(self, segments):
+        # New or changed segments, as (id, segment) pairs
+        self._rasterize_reset()
+        segments = list(segments)
+        last_stroke = max(self._boxes[False], default=-1)
+        boxes = {False: [], True: []}  # Old and new boxes of the changed segments, by layer
+        for segment_id, segment in segments:
+            for region in (False, True):
+                boxes[region].append(self._boxes[region].pop(segment_id, None))
+            self._segments.pop(segment_id, None)
+            region = segment[1] == rasterize.FILL_THICKNESS
+            box = self._box(segment[1], segment[2])
+            if box is not None:
+                self._segments[segment_id] = segment
+                self._boxes[region][segment_id] = box
+            boxes[region].append(box)
+        self._dirty.extend(box for box in boxes[True] if box is not None)
+        segment_id, segment = segments[0] if segments else (None, None)
+        if len(segments) == 1 and segment[1] != rasterize.FILL_THICKNESS and segment_id > last_stroke and boxes[False][0] is None:
+            # A new stroke on top of the others
+            self._draw_on_top(segment, segment[2], boxes[False][-1])
+        else:
+            self._recompute(False, boxes[False])
+
+    def extend(self, segment_id, segment, first_point):
+        # The points from first_point on were appended to the segment
+        self._rasterize_reset()
+        color, thickness, points = segment
+        region = thickness == rasterize.FILL_THICKNESS
+        # The whole inside of a region changes
+        piece = points if region else points[max(first_point - 1, 0):]
+        box = self._box(thickness, piece)
+        old_box = self._boxes[region].get(segment_id)
+        if box is not None:
+            self._segments[segment_id] = segment
+            self._boxes[region][segment_id] = box if old_box is None else self._union([old_box, box])
+        if region:
+            self._dirty.extend(box for box in (old_box, box) if box is not None)
+        elif segment_id == max(self._boxes[False], default=-1):
+            self._draw_on_top(segment, piece, box)
+        else:
+            # A stroke below others is extended
+            self._recompute(False, [old_box, box])
+
+    def remove(self, segment_ids):
+        self._rasterize_reset()
+        boxes = {False: [], True: []}
+        for segment_id in segment_ids:
+            self._segments.pop(segment_id, None)
+            for region in (False, True):
+                boxes[region].append(self._boxes[region].pop(segment_id, None))
+        self._dirty.extend(box for box in boxes[True] if box is not None)
+        self._recompute(False, boxes[False])
+
+    def _box(self, thickness, points):
+        # Pixels of the drawing area that the points may cover, None when there are none
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        if len(points) == 0:
+            return None
+        height, width = self.shape
+        points = points * (width, height) - 0.5
+        reach = int(np.ceil(max(thickness, 1) / 2)) + 1
+        (x_min, y_min), (x_max, y_max) = points.min(axis=0), points.max(axis=0)
+        first_row, end_row = max(int(np.floor(y_min)) - reach, self.rows.start), min(int(np.ceil(y_max)) + reach + 1, self.rows.stop)
+        first_col, end_col = max(int(np.floor(x_min)) - reach, self.cols.start), min(int(np.ceil(x_max)) + reach + 1, self.cols.stop)
+        if first_row >= end_row or first_col >= end_col:
+            return None
+        return first_row, end_row, first_col, end_col
+
+    def _union(self, boxes):
+        boxes = [box for box in boxes if box is not None]
+        if not boxes:
+            return None
+        first_rows, end_rows, first_cols, end_cols = zip(*boxes)
+        return min(first_rows), max(end_rows), min(first_cols), max(end_cols)
+
+    def _set(self, region, box, labels, mask=None):
+        # Write labels in the box of a layer, then the labels of both layers and the counts
+        first_row, end_row, first_col, end_col = box
+        window = (slice(first_row - self.rows.start, end_row - self.rows.start), slice(first_col - self.cols.start, end_col - self.cols.start))
+        if mask is None:
+            self._layers[region][window] = labels
+        else:
+            self._layers[region][window][mask] = labels[mask]
+        strokes = self._layers[False][window]
+        labels = np.where(strokes > 0, strokes, self._layers[True][window])
+        self._counts -= np.bincount(self._labels[window].ravel(), minlength=len(self._counts))[:len(self._counts)]
+        self._counts += np.bincount(labels.ravel(), minlength=len(self._counts))[:len(self._counts)]
+        self._labels[window] = labels
+
+    def _draw_on_top(self, segment, points, box):
+        if box is None:
+            return
+        color, thickness, _ = segment
+        window = (slice(box[0], box[1]), slice(box[2], box[3]))
+        labels = rasterize.rasterize_segments([(color, thickness, points)], self.shape, CLASS_LABELS, self.class_priority, window=window)
+        self._set(False, box, labels, labels > 0)
+
+    def _recompute(self, region, boxes):
+        # Rasterize again the segments of a layer crossing the boxes, in drawing order (ids increase in drawing order)
+        box = self._union(boxes)
+        if box is None:
+            return
+        first_row, end_row, first_col, end_col = box
+        ids = sorted(segment_id for segment_id, (r0, r1, c0, c1) in self._boxes[region].items()
+                     if r0 < end_row and first_row < r1 and c0 < end_col and first_col < c1)
+        window = (slice(first_row, end_row), slice(first_col, end_col))
+        self._set(region, box, rasterize.rasterize_segments([self._segments[segment_id] for segment_id in ids], self.shape, CLASS_LABELS, self.class_priority, window=window))
+
+class AnnotationStore(QObject):
+    # Single annotation model shared by the three canvases.
+    # Every change is a record (a dictionary, see _apply) that is logged in the journal, if any, and
+    # increments the version. The changed segment is reported with its dirty rectangle (in relative image
+    # coordinates), so the views only repaint what changed
+    segment_changed = pyqtSignal(int, QRectF)  # Index of the segment, dirty rectangle
+    area_changed = pyqtSignal(object)  # Segments were removed or inserted: (x_min, y_min, x_max, y_max, thickness) of each
+    reset = pyqtSignal()  # The whole segment list was replaced
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.segments = []  # List of segments, where each segment is a tuple: (color, thickness, list of points)
+        self.ids = []  # Stable id of each segment, unchanged when the segments before it are removed
+        self._next_id = 0
+        self.version = 0
+        self.journal = None  # AnnotationJournal receiving every change
+        self.coverage = None  # CoverageCounter of the drawing area, kept up to date by every change
+        # Built on the first hit test after a reset, then kept up to date by every change
+        self.spatial_index = SegmentIndex()
+        self._index_valid = False
+        # Each undo or redo entry holds the records reverting one action
+        self._undo = []
+        self._redo = []
+        self._action = None  # (records reverting the action being recorded, ids of the segments it added)
+
+    def set_segments(self, segments, ids=None):
+        self.segments = segments
+        self.ids = list(ids) if ids is not None else self._new_ids(len(segments))
+        self._next_id = max(self._next_id, max(self.ids, default=-1) + 1)
+        self._index_valid = False
+        if self.coverage is not None:
+            self.coverage.reset(self.ids, self.segments)
+        self._undo, self._redo, self._action = [], [], None
+        self.version += 1
+        self.reset.emit()
+
+    def add_segment(self, color, thickness, points):
+        segment_id, = self._new_ids(1)
+        self.apply({'op': 'add', 'id': segment_id, 'color': color, 'thickness': thickness, 'points': list(points)})
+        return len(self.segments) - 1
+
+    def extend_segment(self, index, points):
+        self.apply({'op': 'extend', 'id': self.ids[index], 'points': list(points)})
+
+    def replace_points(self, index, points):
+        # Used by the stroke simplification
+        self.apply({'op': 'replace', 'id': self.ids[index], 'points': list(points)})
+
+    def remove_segments(self, segment_ids):
+        segment_ids = set(segment_ids)
+        removed = [segment_id for segment_id in self.ids if segment_id in segment_ids]
+        if removed:
+            self.apply({'op': 'remove', 'ids': removed})
+
+    def segments_at(self, x_rel, y_rel, radius, shape):
+        # Ids of the segments passing within radius image pixels of a point, from the top one to the bottom one
+        # Ids increase in drawing order
+        return sorted(self._index().hits(x_rel, y_rel, radius, shape), reverse=True)
+
+    def segments_in(self, boxes, shape):
+        # Ids of the segments that may cross rectangles (x_min, y_min, x_max, y_max) of relative coordinates
+        return self._index().segments_in(boxes, shape)
+
+    def _index(self):
+        if not self._index_valid:
+            self.spatial_index.rebuild(self.ids, self.segments)
+            self._index_valid = True
+        return self.spatial_index
+
+    def begin_action(self):
+        # The changes until end_action are undone together, e.g. the records of one stroke
+        self.end_action()
+        self._action = ([], set())
+
+    def end_action(self):
+        # The regions drawn by the action are counted once it is over
+        if self.coverage is not None:
+            self.coverage.flush()
+        if self._action is not None:
+            if self._action[0]:
+                self._undo.append(self._action[0])
+            self._action = None
+
+    def apply(self, record):
+        # A change made by the user, which cannot be redone after
+        self._redo.clear()
+        if self._action is not None:
+            self._apply(record)
+        else:
+            self.begin_action()
+            self._apply(record)
+            self.end_action()
+
+    def undo(self):
+        self._revert(self._undo, self._redo)
+
+    def redo(self):
+        self._revert(self._redo, self._undo)
+
+    def _revert(self, source, target):
+        # Apply the records reverting the last action, logged like any other change. The records
+        # reverting them in turn are the entry of the other stack
+        if not source or self._action is not None:
+            return
+        records = source.pop()
+        self._action = ([], set())
+        for record in reversed(records):
+            self._apply(record)
+        target.append(self._action[0])
+        self._action = None
+
+    def replay(self, records):
+        # Apply the records recovered from a journal, they are neither logged again nor undoable
+        journal, self.journal = self.journal, None
+        try:
+            for record in records:
+                self._apply(record)
+        finally:
+            self.journal = journal
+
+    def _apply(self, record):
+        # Records:
+        #   add: new segment id, with its color, thickness and points, drawn on top of the others
+        #   extend: points appended to the segment id
+        #   replace: new points of the segment id
+        #   remove: ids of the segments to remove
+        #   insert: segments put back at their position, as [position, id, color, thickness, points]
+        op = record['op']
+        # Removing a segment added by the same action also reverts its other changes
+        inverted = self._action is not None and (op not in ('extend', 'replace') or record['id'] not in self._action[1])
+        inverse = None
+        if op == 'remove':
+            segment_ids = set(record['ids'])
+            removed = [[position, segment_id, *segment] for position, (segment_id, segment) in enumerate(zip(self.ids, self.segments)) if segment_id in segment_ids]
+            kept = [(segment, segment_id) for segment, segment_id in zip(self.segments, self.ids) if segment_id not in segment_ids]
+            # The list is filtered in place, the canvases only redraw the area of the removed segments
+            self.segments[:] = [segment for segment, _ in kept]
+            self.ids = [segment_id for _, segment_id in kept]
+            if self._index_valid:
+                for segment_id in segment_ids:
+                    self.spatial_index.remove(segment_id)
+            if self.coverage is not None:
+                self.coverage.remove(record['ids'])
+            inverse = {'op': 'insert', 'segments': removed}
+            changed = [(thickness, points) for _, _, _, thickness, points in removed]
+        elif op == 'insert':
+            # In increasing positions, each segment goes back where it was
+            inserted = []
+            for position, segment_id, color, thickness, points in record['segments']:
+                points = points if isinstance(points, np.ndarray) else [tuple(point) for point in points]
+                self.segments.insert(position, (color, thickness, points))
+                self.ids.insert(position, segment_id)
+                inserted.append((segment_id, self.segments[position]))
+                if self._index_valid:
+                    self.spatial_index.add(segment_id, thickness, points)
+            if self.coverage is not None:
+                self.coverage.update(inserted)
+            inverse = {'op': 'remove', 'ids': [segment[1] for segment in record['segments']]}
+            changed = [(segment[1], segment[2]) for _, segment in inserted]
+        else:
+            points = [tuple(point) for point in record['points']]
+            if op == 'add':
+                segment_id = record['id']
+                self._next_id = max(self._next_id, segment_id + 1)
+                self.segments.append((record['color'], record['thickness'], points))
+                self.ids.append(segment_id)
+                index = len(self.segments) - 1
+                dirty_points = points
+                if self._index_valid:
+                    self.spatial_index.add(segment_id, record['thickness'], self.segments[index][2])
+                if self.coverage is not None:
+                    self.coverage.update([(segment_id, self.segments[index])])
+                inverse = {'op': 'remove', 'ids': [segment_id]}
+            else:
+                segment_id = record['id']
+                # Strokes are extended while they are the last segment
+                index = len(self.ids) - 1 if self.ids[-1] == segment_id else self.ids.index(segment_id)
+                color, thickness, segment_points = self.segments[index]
+                if op == 'extend':
+                    # The new line starts from the last point of the segment, the whole inside of a region changes
+                    dirty_points = (segment_points if thickness == rasterize.FILL_THICKNESS else segment_points[-1:]) + points
+                    first_piece = max(len(segment_points) - 1, 0)
+                    if inverted:
+                        inverse = {'op': 'replace', 'id': segment_id, 'points': list(segment_points)}
+                    first_point = len(segment_points)
+                    segment_points.extend(points)
+                    if self._index_valid:
+                        self.spatial_index.add(segment_id, thickness, segment_points, first_piece)
+                    if self.coverage is not None:
+                        self.coverage.extend(segment_id, self.segments[index], first_point)
+                else:
+                    # The dirty rectangle covers the old and the new points
+                    dirty_points = list(segment_points) + points
+                    inverse = {'op': 'replace', 'id': segment_id, 'points': segment_points}
+                    self.segments[index] = (color, thickness, points)
+                    if self._index_valid:
+                        self.spatial_index.add(segment_id, thickness, points)
+                    if self.coverage is not None:
+                        self.coverage.update([(segment_id, self.segments[index])])
+        if self.journal is not None:
+            self.journal.append(record)
+        if inverted:
+            self._action[0].append(inverse)
+            if op == 'add':
+                self._action[1].add(record['id'])
+        if op in ('remove', 'insert'):
+            self._area_changed(changed)
+        else:
+            self._changed(index, dirty_points)
+
+    def _new_ids(self, count):
+        ids = list(range(self._next_id, self._next_id + count))
+        self._next_id += count
+        return ids
+
+    def _changed(self, index, points):
+        self.version += 1
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        x_min, y_min = points.min(axis=0)
+        x_max, y_max = points.max(axis=0)
+        self.segment_changed.emit(index, QRectF(x_min, y_min, x_max - x_min, y_max - y_min))
+
+    def _area_changed(self, segments):
+        # (thickness, points) of the segments removed or inserted, the views redraw the bounding box of each
+        self.version += 1
+        boxes = []
+        for thickness, points in segments:
+            points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+            if len(points):
+                boxes.append((*points.min(axis=0).tolist(), *points.max(axis=0).tolist(), thickness))
+        if boxes:
+            self.area_changed.emit(boxes)
+
 class MainWindow(QTabWidget):
-    def __init__(self, sonar_image, bathy_image, tri_image, output_folder,file_prefix):        
+    def __init__(self, sonar_image, bathy_image, tri_image, output_folder,file_prefix, dataset=None):        
         super().__init__()
-        self.segments = []  # Store the segments in MainWindow so they can be saved later
-        self.setWindowTitle('Image Display')
+        self.annotations = AnnotationStore(self)  # Store the segments in MainWindow so they can be saved later
+        self.stroke_in_progress = False  # True while the last segment is still being drawn
+        self.setWindowTitle('Image Display - ' + file_prefix)
+
+        # The other tiles of the folder, the neighbours of the current one are prepared in the background
+        self.dataset = dataset if dataset is not None else DatasetIndex(os.path.dirname(sonar_image))
+        self.prefetcher = TilePrefetcher(self.dataset)
+        images = self.prefetcher.get(file_prefix) if file_prefix in self.dataset.triplets else (None, None, None)
 
-        self.image_widget1 = ImageWidget(sonar_image, self)
-        self.image_widget2 = ImageWidget(bathy_image, self)
-        self.image_widget3 = ImageWidget(tri_image, self)
+        self.image_widget1 = ImageWidget(sonar_image, self, images[0])
+        self.image_widget2 = ImageWidget(bathy_image, self, images[1])
+        self.image_widget3 = ImageWidget(tri_image, self, images[2])
 
         self.image_widget1.canvas.show()
         self.image_widget2.canvas.show()
         self.image_widget3.canvas.show()
 
+        # The canvases repaint themselves from the changes of the shared annotations
+        for image_widget in [self.image_widget1, self.image_widget2, self.image_widget3]:
+            self.annotations.segment_changed.connect(image_widget.canvas.on_segment_changed)
+            self.annotations.area_changed.connect(image_widget.canvas.on_area_changed)
+            self.annotations.reset.connect(image_widget.canvas.invalidate_layer)
+
         self.layout = QHBoxLayout()
         self.layout.setSpacing(30)  # Add 30 px space between widgets
         self.layout.addWidget(self.image_widget1)
@@ -238,18 +997,159 @@ class MainWindow(QTabWidget):
         self.pencil_thickness = 1  # Default pencil thickness: 3 pixels
 
         self.pencil_button.toggled.connect(self.update_canvas_mouse_events)
-        self.pencil_button.toggled.connect(self.update_canvas_visibility)
+
+        # The eraser removes the strokes under the cursor, the selection picks strokes to delete with the Delete key
+        self.eraser_button = QPushButton('Eraser', self.container)
+        self.eraser_button.setCheckable(True)
+        self.layout.addWidget(self.eraser_button, alignment=Qt.AlignTop | Qt.AlignLeft)
+        self.select_button = QPushButton('Select', self.container)
+        self.select_button.setCheckable(True)
+        self.layout.addWidget(self.select_button, alignment=Qt.AlignTop | Qt.AlignLeft)
+        # The fill tool draws the outline of a region, its whole inside gets the class
+        self.fill_button = QPushButton('Fill', self.container)
+        self.fill_button.setCheckable(True)
+        self.layout.addWidget(self.fill_button, alignment=Qt.AlignTop | Qt.AlignLeft)
+        self.fill_button.toggled.connect(self.update_canvas_mouse_events)
+        self.tool_buttons = [self.pencil_button, self.eraser_button, self.select_button, self.fill_button]
+        for button in self.tool_buttons:
+            button.toggled.connect(lambda checked, button=button: self.on_tool_toggled(button, checked))
+        self.selected_ids = set()  # Ids of the selected segments
+        QShortcut(QKeySequence.Delete, self, self.delete_selection)
+        # The three views are zoomed (mouse wheel) and dragged (middle button) together, Ctrl+0 shows the whole
+        # images again and Ctrl+F frames the drawing area
+        self.view_zoom = 1
+        self.view_center = (0.5, 0.5)
+        QShortcut(QKeySequence('Ctrl+0'), self, lambda: self.set_view(1, (0.5, 0.5)))
+        QShortcut(QKeySequence('Ctrl+F'), self, self.frame_drawing_area)
+        # Pixels of every class in the drawing area, refreshed at most every COVERAGE_REFRESH ms while drawing
+        self.coverage_label = QLabel(self.container)
+        self.coverage_label.setTextFormat(Qt.RichText)
+        self.layout.addWidget(self.coverage_label, alignment=Qt.AlignTop | Qt.AlignLeft)
+        self.coverage_timer = QTimer(self)
+        self.coverage_timer.setSingleShot(True)
+        self.coverage_timer.setInterval(COVERAGE_REFRESH)
+        self.coverage_timer.timeout.connect(self.update_coverage)
+        self.annotations.segment_changed.connect(self.schedule_coverage_update)
+        self.annotations.area_changed.connect(self.schedule_coverage_update)
+        self.annotations.reset.connect(self.schedule_coverage_update)
 
         self.save_button = QPushButton('Save', self.container)
         self.layout.addWidget(self.save_button, alignment=Qt.AlignTop | Qt.AlignRight)
         self.save_button.clicked.connect(self.save)
+        # Saves run one after the other in a worker thread
+        self.save_executor = ThreadPoolExecutor(max_workers=1)
+        self.pending_saves = []
+        self.save_signals = SaveSignals(self)
+        self.save_signals.finished.connect(self._save_finished)
+        self.save_signals.failed.connect(self._save_failed)
+
+        # Move to the previous or next tile of the folder
+        self.previous_button = QPushButton('Previous', self.container)
+        self.layout.addWidget(self.previous_button, alignment=Qt.AlignTop | Qt.AlignRight)
+        self.previous_button.clicked.connect(lambda: self.show_tile(self.dataset.previous(self.file_prefix)))
+        self.next_button = QPushButton('Next', self.container)
+        self.layout.addWidget(self.next_button, alignment=Qt.AlignTop | Qt.AlignRight)
+        self.next_button.clicked.connect(lambda: self.show_tile(self.dataset.next(self.file_prefix)))
 
         self.output_folder = output_folder 
         self.file_prefix = file_prefix  
-        self.load()  # Load existing annotations
+        # Every change is logged in the journal of the tile, written to disk periodically
+        self.journal = None
+        self.journal_timer = QTimer(self)
+        self.journal_timer.timeout.connect(self.sync_journal)
+        self.journal_timer.start(JOURNAL_SYNC_INTERVAL)
+        QShortcut(QKeySequence.Undo, self, self.undo)
+        # Ctrl+Shift+T starts and stops a trace of the hot paths, Ctrl+Shift+O shows their timings in the tab bar
+        QShortcut(QKeySequence('Ctrl+Shift+T'), self, self.toggle_trace)
+        QShortcut(QKeySequence('Ctrl+Shift+O'), self, lambda: self.set_overlay(not tracer.overlay))
+        self.overlay_label = QLabel(self)
+        self.setCornerWidget(self.overlay_label, Qt.TopRightCorner)
+        self.overlay_timer = QTimer(self)
+        self.overlay_timer.timeout.connect(self.update_overlay)
+        self.set_overlay(tracer.overlay)
+        QShortcut(QKeySequence.Redo, self, self.redo)
+        self.load()  # Load existing annotations, sets the version of the annotations when they were last saved
+        self.update_navigation()
 
         
 
+    @traced('MainWindow.show_tile')
+    def show_tile(self, prefix):
+        # Replace the images and the annotations by those of another tile of the folder
+        if prefix is None:
+            return
+        if self.annotations.version != self.saved_version:
+            self.save()  # The snapshot is taken now, the files are written in the background
+        try:
+            images = self.prefetcher.get(prefix)
+        except Exception as error:
+            QMessageBox.warning(self, 'Loading failed', f'The images of {prefix} could not be loaded:\n{error}')
+            return
+
+        self.file_prefix = prefix
+        self.setWindowTitle('Image Display - ' + prefix)
+        self.stroke_in_progress = False
+        self.set_selection(set())
+        for image_widget, image in zip([self.image_widget1, self.image_widget2, self.image_widget3], images):
+            image_widget.set_image(image)
+        self.load()
+        self.update_navigation()
+
+    def update_navigation(self):
+        previous_prefix = self.dataset.previous(self.file_prefix) if self.file_prefix in self.dataset.triplets else None
+        next_prefix = self.dataset.next(self.file_prefix) if self.file_prefix in self.dataset.triplets else None
+        self.previous_button.setEnabled(previous_prefix is not None)
+        self.next_button.setEnabled(next_prefix is not None)
+        # Prepare the neighbours while this tile is annotated
+        self.prefetcher.prefetch([next_prefix, previous_prefix])
+
+    def on_tool_toggled(self, button, checked):
+        # Only one tool is active at a time, the canvases are shown while a tool is active
+        if checked:
+            for other in self.tool_buttons:
+                if other is not button:
+                    other.blockSignals(True)
+                    other.setChecked(False)
+                    other.blockSignals(False)
+        if button is not self.select_button or not checked:
+            self.set_selection(set())
+        self.update_canvas_visibility(any(tool.isChecked() for tool in self.tool_buttons))
+
+    def set_view(self, zoom, center):
+        # Zoom and center (relative image coordinates) of the three views, the view stays inside the images
+        zoom = min(max(zoom, 1), MAX_ZOOM)
+        half = 0.5 / zoom
+        center = tuple(min(max(value, half), 1 - half) for value in center)
+        if (zoom, center) == (self.view_zoom, self.view_center):
+            return
+        self.view_zoom, self.view_center = zoom, center
+        with tracer.span('MainWindow.set_view'):
+            for image_widget in [self.image_widget1, self.image_widget2, self.image_widget3]:
+                image_widget.set_view(zoom, center)
+
+    def zoom_view(self, factor, anchor):
+        # Zoom by factor, the point anchor (relative image coordinates) stays in place
+        zoom = min(max(self.view_zoom * factor, 1), MAX_ZOOM)
+        self.set_view(zoom, tuple(point - (point - center) * self.view_zoom / zoom for point, center in zip(anchor, self.view_center)))
+
+    def frame_drawing_area(self):
+        height, width = self.image_widget1.image_shape
+        rows, cols = self.image_widget1.drawing_area
+        # The drawing area takes 90% of the views
+        zoom = 0.9 / max((rows.stop - rows.start) / height, (cols.stop - cols.start) / width)
+        self.set_view(zoom, ((cols.start + cols.stop) / 2 / width, (rows.start + rows.stop) / 2 / height))
+
+    def set_selection(self, segment_ids):
+        if segment_ids != self.selected_ids:
+            self.selected_ids = segment_ids
+            for image_widget in [self.image_widget1, self.image_widget2, self.image_widget3]:
+                image_widget.canvas.update()
+
+    def delete_selection(self):
+        if self.selected_ids:
+            self.annotations.remove_segments(self.selected_ids)
+            self.set_selection(set())
+
     def update_canvas_visibility(self, checked):
         visible_widgets = [widget for widget in [self.image_widget1, self.image_widget2, self.image_widget3] if widget.isVisible()]
         for widget in visible_widgets:
@@ -294,248 +1194,483 @@ class MainWindow(QTabWidget):
 
     def update_canvas_mouse_events(self, checked):
         if checked:
-            self.colormap={'Posidonie': QColor('#0b9224'), 'Enrochement': QColor('#969d97'), 'Matte': QColor('#d55e09'), 'Anthropique': QColor('#0c03d2'), 'Cymodecee': QColor('#20e4db'), 'Sediment' : QColor('#fef22f'), 'Roche' : QColor('#751f1c'), 'BlocGaletGravier' : QColor('#524e44'), 'SedimentRide' : QColor('#a28446')} 
+            self.colormap = {name: QColor(color) for name, color in CLASS_COLORS.items()}
 
             # Assuming colormap is a dictionary with keys as names and values as QColor objects
             color_name = QInputDialog.getItem(self, 'Select Pencil Color', 'Choose a color:', list(self.colormap.keys()))
             if color_name[1]:  # If user pressed OK
                 self.pencil_color = self.colormap[color_name[0]].name()
         
-        self.image_widget1.canvas.set_segments(self.segments.copy())  # update() will be called inside set_segments()
-        self.image_widget2.canvas.set_segments(self.segments.copy())
-        self.image_widget3.canvas.set_segments(self.segments.copy())
-
-    def update(self):
-        # Clear the image
-        self.image.fill(Qt.white)
-        painter = QPainter(self.image)
-        
-        # Redraw all segments
-        for color, thickness, points in self.segments:
-            painter.setPen(QPen(QColor(color), thickness))
-            for i in range(1, len(points)):
-                painter.drawLine(QPoint(*points[i - 1]), QPoint(*points[i]))
+        self.image_widget1.canvas.update()
+        self.image_widget2.canvas.update()
+        self.image_widget3.canvas.update()
 
-        # Force a repaint event
-        self.repaint()
+    @property
+    def segments(self):
+        return self.annotations.segments
 
-    def load(self):
-        # Get the base name (file name with extension) from one of the selected image paths
-        annot_file_path= os.path.join(self.output_folder, self.file_prefix + '_annot.json')        # Get the base name without extension
-        print(annot_file_path)
-
-        if os.path.exists(annot_file_path):
-            with open(annot_file_path, 'r') as f:
-                segments_data = json.load(f)
-            
-            segments = [
-                (
-                    data['color'], 
-                    data['thickness'], 
-                    [(float(x[0]), float(x[1])) for x in data['points']]  # Convert list back to tuple
-                ) 
-                for data in segments_data
-            ]
-            
-            self.segments = segments
-            
-            # Apply the loaded annotations to all image widgets
-            for image_widget in [self.image_widget1, self.image_widget2, self.image_widget3]:
-                image_widget.segments = segments  # Update the segments for this image widget
-                image_widget.update()  # Redraw the widget
+    @segments.setter
+    def segments(self, segments):
+        self.annotations.set_segments(segments)
 
+    @traced('MainWindow.load')
+    def load(self):
+        # A save of this tile still being written would be read half way
+        for future in self.pending_saves:
+            if future.file_prefix == self.file_prefix:
+                future.exception()
+        # Load the most recent annotation file of this image, .npz or .json
+        annot_file_path = find_annotation_file(self.output_folder, self.file_prefix)
+
+        segments = []
+        if annot_file_path is not None:
+            segments = load_annotations(annot_file_path)
+            if SIMPLIFY_ON_LOAD:
+                # The file itself is only rewritten by the next save
+                segments = simplify_segments(segments, SIMPLIFY_TOLERANCE, self.image_widget1.image_shape)
+
+        # Changes left in the journal by a session that did not save them, e.g. after a crash
+        if self.journal is not None:
+            self.journal.close()
+        journal_path = os.path.join(self.output_folder, self.file_prefix + '_annot.journal')
+        recovered = recover_journal(journal_path, annot_file_path, len(segments))
+        self.annotations.journal = None
+        self.annotations.coverage = CoverageCounter(self.image_widget1.image_shape, self.image_widget1.drawing_area, self.image_widget1.class_priority)
+        # The canvases redraw the annotations from scratch when the store is reset
+        self.annotations.set_segments(segments, recovered[0] if recovered else None)
+        self.saved_version = self.annotations.version  # Version of the annotations when they were last saved
+        self.journal = AnnotationJournal(journal_path, journal_header(annot_file_path, self.annotations.ids))
+        if recovered:
+            self.annotations.replay(recovered[1])
+            print(f'Recovered {len(recovered[1])} changes from {journal_path}')
+            # The journal now starts from the annotation file as it is
+            self.journal.rewrite(recovered[1])
+        elif os.path.exists(journal_path):
+            print(f'{journal_path} does not match the annotation file, it is kept as {journal_path}.stale')
+            os.replace(journal_path, journal_path + '.stale')
+        self.annotations.journal = self.journal
+
+    def schedule_coverage_update(self, *args):
+        if not self.coverage_timer.isActive():
+            self.coverage_timer.start()
+
+    def update_coverage(self):
+        coverage = self.annotations.coverage
+        if coverage is None:
+            return
+        area = max(coverage.area, 1)
+        lines = []
+        for name, color in CLASS_COLORS.items():
+            count = coverage.counts[CLASS_LABELS[color]]
+            if count:
+                lines.append(f'<span style="color:{color}">&#9632;</span> {name}: {count} px ({count / area:.1%})')
+        labeled = coverage.area - coverage.counts[0]
+        lines.append(f'<b>Labeled: {labeled} px ({labeled / area:.1%})</b>')
+        self.coverage_label.setText('<br>'.join(lines))
+
+    def toggle_trace(self):
+        # The trace is written next to the outputs when it is stopped
+        if tracer.recording:
+            tracer.set_recording(False)
+            tracer.dump(os.path.join(self.output_folder, time.strftime('trace-%Y%m%d-%H%M%S.json')))
+        else:
+            tracer.set_recording(True)
+            print('Tracing, press Ctrl+Shift+T again to write the trace')
+
+    def set_overlay(self, visible):
+        tracer.set_overlay(visible)
+        self.overlay_label.setVisible(visible)
+        if visible:
+            tracer.take_totals()
+            self.overlay_timer.start(1000)
+        else:
+            self.overlay_timer.stop()
+
+    def update_overlay(self):
+        # Mean duration and rate of the spans over the last second
+        interval = self.overlay_timer.interval() / 1000
+        totals = tracer.take_totals()
+        parts = []
+        for label, name in (('paint', 'CanvasWidget.paintEvent'), ('image', 'ImageWidget.update_image'), ('scale', 'ImageWidget.scale_pixmap')):
+            count, duration = totals.get(name, (0, 0.0))
+            if count:
+                parts.append(f'{label} {duration / count * 1000:.1f} ms {count / interval:.0f}/s')
+        count = totals.get('CanvasWidget.mouseMoveEvent', (0, 0.0))[0]
+        parts.append(f'input {count / interval:.0f}/s')
+        self.overlay_label.setText('  |  '.join(parts))
+
+    def sync_journal(self):
+        if self.journal is not None:
+            self.journal.sync()
+
+    def undo(self):
+        if not self.stroke_in_progress:
+            self.annotations.undo()
+
+    def redo(self):
+        if not self.stroke_in_progress:
+            self.annotations.redo()
 
     def save(self):
-        color_map = {
-            '#0b9224': 1, 
-            '#969d97': 2, 
-            '#d55e09': 3, 
-            '#0c03d2': 4,
-            '#20e4db': 5, 
-            '#fef22f': 6, 
-            '#751f1c': 7, 
-            '#524e44': 8,
-            '#a28446': 9
-        }
-
-        # Interesting rows and columns
-        interesting_rows = np.array([ 379, 380, 381, 382, 383, 384, 385, 386, 387, 388, 389, 390, 391, 392, 393, 394, 395,
-        414, 415, 416, 417, 418, 419, 420, 421, 422, 423, 424, 425, 426, 427, 428, 429, 430, 431,
-        432, 433, 434, 435, 436, 437, 438, 439, 440, 441, 442, 443, 444, 445, 446, 447, 448, 449,
-        450, 451, 452, 453, 454, 455, 456, 457, 458, 459, 460, 461, 462, 463, 464, 465, 466, 467,
-        468, 469, 470, 471, 472, 473, 474, 475, 476, 477, 478, 479])
-
-        interesting_cols = np.array([ 214, 215, 216, 217, 218, 219, 220, 221, 222, 223, 224, 225, 226, 227, 228, 229, 230,
-        249, 250, 251, 252, 253, 254, 255, 256, 257, 258, 259, 260, 261, 262, 263, 264, 265, 266,
-        267, 268, 269, 270, 271, 272, 273, 274, 275, 276, 277, 278, 279, 280, 281, 282, 283, 284,
-        285, 286, 287, 288, 289, 290, 291, 292, 293, 294, 295, 296, 297, 298, 299, 300, 301, 302,
-        303, 304, 305, 306, 307, 308, 309, 310, 311, 312, 313, 314])
-
-        # Create an empty matrix
-        image_matrix = np.zeros((self.image_widget1.pixmap.height(), self.image_widget1.pixmap.width()))
-
-        # Convert segments to matrix
-        for color, _, points in self.segments:
-            # Convert color from #RRGGBB to QColor and then to integer value in color_map
-            color_value = color_map[QColor(color).name()]
-            for i in range(1, len(points)):
-                point1 = points[i - 1]
-                point2 = points[i]
-
-                # Convert the points from relative to absolute coordinates
-                x1_abs, y1_abs = self.image_widget1.canvas._image_relative_to_widget_absolute(point1)
-                x2_abs, y2_abs = self.image_widget1.canvas._image_relative_to_widget_absolute(point2)
-
-                # Add the segment to the image matrix
-                x1, x2 = map(int, [x1_abs, x2_abs])
-                y1, y2 = map(int, [y1_abs, y2_abs])
-                rr, cc = line(y1, x1, y2, x2)  # Using Bresenham's line algorithm from skimage library
-
-                # Check that the coordinates are within the valid range
-                valid_indices = (0 <= rr) & (rr < image_matrix.shape[0]) & (0 <= cc) & (cc < image_matrix.shape[1])
-                rr = rr[valid_indices]
-                cc = cc[valid_indices]
-
-                image_matrix[rr, cc] = color_value
-
-        # Crop to interesting rows and columns
-        image_matrix = image_matrix[np.min(interesting_rows):np.max(interesting_rows)+1, np.min(interesting_cols):np.max(interesting_cols)+1]
-
-        output_path = os.path.join(self.output_folder, self.file_prefix + '_output.npy')
-        np.save(output_path, image_matrix)
-        
-
-        file_path = os.path.join(self.output_folder, self.file_prefix  + '_annot.json')
-
-        segments_data = [{
-            'color': segment[0],
-            'thickness': segment[1],
-            'points': [[float(x) for x in point] for point in segment[2]]  
-        } for segment in self.segments]
-
-        with open(file_path, 'w') as f:
-            json.dump(segments_data, f)
+        # Save in the background from an immutable snapshot of the segments, the drawing can go on meanwhile
+        with tracer.span('MainWindow.save'):
+            snapshot = tuple((color, thickness, np.array(points, dtype=np.float64).reshape(-1, 2)) for color, thickness, points in self.segments)
+            self.saved_version = self.annotations.version
+            output_path = os.path.join(self.output_folder, self.file_prefix + '_output.npy')
+            annot_path = os.path.join(self.output_folder, self.file_prefix + '_annot.' + ANNOTATION_FORMAT)
+            # Once the files are written, the journal only keeps the changes made after the snapshot
+            journal = self.journal
+            mark = journal.mark(self.annotations.ids)
+        shape = self.image_widget1.image_shape
+        window = self.image_widget1.drawing_area
+        priority = self.image_widget1.class_priority
+        def write():
+            result = write_annotation_outputs(snapshot, shape, window, output_path, annot_path, priority)
+            journal.cut(mark, annot_path)
+            return result
+        future = self.save_executor.submit(write)
+        future.file_prefix = self.file_prefix
+        self.pending_saves.append(future)
+        self.save_button.setText('Saving...')
+        # The callback runs in the worker thread, the signals bring the result back to the GUI thread
+        future.add_done_callback(self._on_save_done)
+
+    def _on_save_done(self, future):
+        error = future.exception()
+        if error is None:
+            self.save_signals.finished.emit(future.result())
+        else:
+            self.save_signals.failed.emit(str(error))
 
-        
+    def _save_finished(self, output_path):
+        self.pending_saves = [future for future in self.pending_saves if not future.done()]
+        if not self.pending_saves:
+            self.save_button.setText('Save')
         print('Saved to', output_path)
 
+    def _save_failed(self, message):
+        self.pending_saves = [future for future in self.pending_saves if not future.done()]
+        if not self.pending_saves:
+            self.save_button.setText('Save')
+        QMessageBox.warning(self, 'Save failed', 'The annotations could not be saved:\n' + message)
+
+    def flush_saves(self):
+        # Block until the pending saves are written
+        for future in list(self.pending_saves):
+            future.exception()  # Waits for the save, errors are reported by _save_failed
+
+    def closeEvent(self, event):
+        # Do not leave before the pending saves are on disk
+        if self.pending_saves:
+            QApplication.setOverrideCursor(Qt.WaitCursor)
+            self.flush_saves()
+            QApplication.restoreOverrideCursor()
+        self.save_executor.shutdown(wait=True)
+        self.prefetcher.shutdown()
+        # The changes not saved stay in the journal, they are recovered at the next load
+        self.journal_timer.stop()
+        if self.journal is not None:
+            self.journal.close()
+        if tracer.recording and os.environ.get('ANNOTATION_TRACE'):
+            tracer.set_recording(False)
+            tracer.dump(os.environ['ANNOTATION_TRACE'])
+        super().closeEvent(event)
+
+class SaveSignals(QObject):
+    # Report the end of a background save to the GUI thread
+    finished = pyqtSignal(str)  # Path of the label matrix
+    failed = pyqtSignal(str)  # Error message
+
+class RenderSignals(QObject):
+    # Deliver a render of the worker thread of an ImageWidget to the GUI thread
+    rendered = pyqtSignal(int, object)  # Generation of the render and its future
+
 class CanvasWidget(QWidget):
     def __init__(self, parent=None):
         super().__init__(parent)
         self.drawing = False
+        self.erasing = False
+        self._skipped_point = None  # Last mouse position not added to the stroke, too close to the previous point
         self.points = []  # This will now store tuples of (relative x, relative y)
         self.segments = []  # List of segments, where each segment is a tuple: (color, thickness, list of points)
-        self.drawing_area_fraction = 0.1943125  # The fraction of the image that will be used as the drawing area
+        # Finished segments are drawn once into this layer, which is rebuilt only on resize, opacity change or load.
+        # Removing or inserting segments only redraws their area
+        self._layer = None
+        self._layer_key = None
+        self._layer_segments = None  # The segment list the layer was drawn from
+        self._layer_last_id = -1  # Id of the last segment drawn into the layer, the later ones are drawn on the next paint
+        # (x_min, y_min, x_max, y_max, thickness) of the segments removed or inserted since the last paint
+        self._layer_dirty = []
+        # When zoomed, the layer covers a margin around the widget and is drawn at the offset of the view from
+        # _layer_origin, so that panning within the margin does not redraw it
+        self._layer_origin = (0, 0)
+        self._layer_margin = (0, 0)
+        # Changes of the annotations are accumulated and repainted at most once per display refresh
+        self._dirty_rect = QRect()
+        self._repaint_timer = QTimer(self)
+        self._repaint_timer.setSingleShot(True)
+        self._repaint_timer.timeout.connect(self._repaint_dirty_rect)
         #Put a border around the canvas
         self.raise_()
         self.setStyleSheet("border: 10px solid white;")
         self.show()
 
-    def set_points(self, points):
-        self.points = points
-        self.update()
-
-    def set_segments(self, segments):
-        self.segments = segments
-        self.update()
-
     def mousePressEvent(self, event):
-        if main_window.pencil_button.isChecked() and self._is_in_drawing_area(event.pos()):
+        if event.button() == Qt.MiddleButton:
+            # Dragging the view is handled by the image widget
+            event.ignore()
+            return
+        if (main_window.pencil_button.isChecked() or main_window.fill_button.isChecked()) and self._is_in_drawing_area(event.pos()):
             self.drawing = True
+            main_window.stroke_in_progress = True
             x_rel, y_rel = self._event_pos_to_image_relative(event.pos())
-            main_window.segments.append((main_window.pencil_color, main_window.pencil_thickness, [(x_rel, y_rel)]))
-            # Also set segments for the other canvases
-            for image_widget in [main_window.image_widget1, main_window.image_widget2, main_window.image_widget3]:
-                if image_widget.canvas is not self:
-                    image_widget.canvas.set_segments(main_window.segments.copy())  # copy() to prevent aliasing
-
+            thickness = rasterize.FILL_THICKNESS if main_window.fill_button.isChecked() else main_window.pencil_thickness
+            # All the canvases are notified by the annotation store, the stroke is undone as a whole
+            main_window.annotations.begin_action()
+            main_window.annotations.add_segment(main_window.pencil_color, thickness, [(x_rel, y_rel)])
+        elif main_window.eraser_button.isChecked():
+            self.erasing = True
+            main_window.annotations.begin_action()
+            self._erase_at(event.pos())
+        elif main_window.select_button.isChecked():
+            self._select_at(event.pos(), event.modifiers() & Qt.ShiftModifier)
+
+    @traced('CanvasWidget.mouseMoveEvent')
     def mouseMoveEvent(self, event):
-        if self.drawing and main_window.pencil_button.isChecked() and self._is_in_drawing_area(event.pos()):
+        if self.erasing:
+            self._erase_at(event.pos())
+            return
+        if self.drawing and self._is_in_drawing_area(event.pos()):
             x_rel, y_rel = self._event_pos_to_image_relative(event.pos())
-            main_window.segments[-1][2].append((x_rel, y_rel))
-            # Also set segments for the other canvases
-            for image_widget in [main_window.image_widget1, main_window.image_widget2, main_window.image_widget3]:
-                if image_widget.canvas is not self:
-                    image_widget.canvas.set_segments(main_window.segments.copy())  # copy() to prevent aliasing
-            self.update()
+            # Mouse events closer than the tolerance to the last point are skipped
+            last_x, last_y = main_window.segments[-1][2][-1]
+            height, width = self.parent().image_shape
+            if np.hypot((x_rel - last_x) * width, (y_rel - last_y) * height) < SIMPLIFY_TOLERANCE:
+                self._skipped_point = (x_rel, y_rel)
+                return
+            self._skipped_point = None
+            main_window.annotations.extend_segment(len(main_window.segments) - 1, [(x_rel, y_rel)])
+
+    def mouseReleaseEvent(self, event):
+        if self.erasing:
+            self.erasing = False
+            main_window.annotations.end_action()
+        if self.drawing:
+            index = len(main_window.segments) - 1
+            # The stroke ends where the mouse was last seen
+            if self._skipped_point is not None:
+                main_window.annotations.extend_segment(index, [self._skipped_point])
+                self._skipped_point = None
+            points = main_window.segments[index][2]
+            simplified = simplify_points(points, SIMPLIFY_TOLERANCE, self.parent().image_shape)
+            if len(simplified) < len(points):
+                main_window.annotations.replace_points(index, simplified)
+            main_window.annotations.end_action()
+            # The stroke is finished, it will be drawn into the cached layer from now on
+            self.drawing = False
+            main_window.stroke_in_progress = False
+
+    def _segments_under(self, pos, radius):
+        # Segments within radius screen pixels of a widget position, from the top one to the bottom one
+        x_rel, y_rel = self._event_pos_to_image_relative(pos)
+        image_shape = self.parent().image_shape
+        return main_window.annotations.segments_at(x_rel, y_rel, radius * image_shape[1] / self._display_transform()[0], image_shape)
+
+    def _erase_at(self, pos):
+        segment_ids = self._segments_under(pos, ERASER_RADIUS)
+        if segment_ids:
+            main_window.annotations.remove_segments(segment_ids)
+            main_window.set_selection(main_window.selected_ids.difference(segment_ids))
+
+    def _select_at(self, pos, add):
+        # A click selects the top segment under the cursor, with Shift it is added to or removed from the selection
+        segment_ids = self._segments_under(pos, SELECT_RADIUS)[:1]
+        if add:
+            main_window.set_selection(main_window.selected_ids.symmetric_difference(segment_ids))
+        else:
+            main_window.set_selection(set(segment_ids))
+
+    def on_segment_changed(self, index, rect_rel):
+        # The store sending the change, the main window may still be under construction when a journal is replayed
+        self._schedule_repaint(rect_rel, self.sender().segments[index][1])
+
+    def on_area_changed(self, boxes):
+        # Segments were removed or inserted, their area of the layer is drawn again on the next paint
+        self._layer_dirty.extend(boxes)
+        for x_min, y_min, x_max, y_max, thickness in boxes:
+            self._schedule_repaint(QRectF(x_min, y_min, x_max - x_min, y_max - y_min), thickness)
+
+    def _schedule_repaint(self, rect_rel, thickness):
+        # Convert the dirty rectangle to widget coordinates, with a margin for the pen width
+        scale_x, scale_y, offset_x, offset_y = self._display_transform()
+        margin = int(thickness * scale_x / self.parent().image_shape[1]) + 2
+        rect = QRectF(rect_rel.x() * scale_x + offset_x, rect_rel.y() * scale_y + offset_y,
+                      rect_rel.width() * scale_x, rect_rel.height() * scale_y)
+        self._dirty_rect = self._dirty_rect.united(rect.toAlignedRect().adjusted(-margin, -margin, margin, margin))
+        if not self._repaint_timer.isActive():
+            screen = self.screen()
+            refresh_rate = screen.refreshRate() if screen is not None else 60
+            self._repaint_timer.start(int(1000 / max(refresh_rate, 1)))
+
+    def _repaint_dirty_rect(self):
+        self.update(self._dirty_rect)
+        self._dirty_rect = QRect()
             
     def _is_in_drawing_area(self, pos):
-        pixmap = self.parent().pixmap
-        image_label = self.parent().image_label
-
-        # Calculate scale factor between pixmap and label
-        scale_factor = min(image_label.width() / pixmap.width(), image_label.height() / pixmap.height())
-
-        # Calculate the size and position of the drawing area
-        drawing_area_size = scale_factor * pixmap.width() * self.drawing_area_fraction
-        drawing_area_x = (image_label.width() - drawing_area_size) / 2
-        drawing_area_y = (image_label.height() - drawing_area_size) / 2
-
-        # Check if the position is within the drawing area
-        return (drawing_area_x <= pos.x() <= drawing_area_x + drawing_area_size) and (drawing_area_y <= pos.y() <= drawing_area_y + drawing_area_size)
+        # The drawing area is the window of the image that is exported, see drawing_area_window. When zoomed, only its
+        # visible part
+        if not self.parent().viewport().contains(QPointF(pos)):
+            return False
+        x_rel, y_rel = self._event_pos_to_image_relative(pos)
+        height, width = self.parent().image_shape
+        rows, cols = self.parent().drawing_area
+        return cols.start / width <= x_rel <= cols.stop / width and rows.start / height <= y_rel <= rows.stop / height
     
     def _event_pos_to_image_relative(self, pos):
-        pixmap = self.parent().pixmap
-        image_label = self.parent().image_label
+        scale_x, scale_y, offset_x, offset_y = self._display_transform()
 
-        # Calculate scale factor between pixmap and label
-        scale_factor = min(image_label.width() / pixmap.width(), image_label.height() / pixmap.height())
-
-        # Calculate the empty space due to aspect ratio preservation
-        empty_space_x = (image_label.width() - scale_factor * pixmap.width()) / 2
-        empty_space_y = (image_label.height() - scale_factor * pixmap.height()) / 2
-
-        # Adjust the position to take into account the empty space
-        pos_adjusted_x = pos.x() - empty_space_x
-        pos_adjusted_y = pos.y() - empty_space_y
-
-        # Convert to relative position
-        x_rel = pos_adjusted_x / (scale_factor * pixmap.width())
-        y_rel = pos_adjusted_y / (scale_factor * pixmap.height())
+        # Remove the empty space due to aspect ratio preservation and convert to relative position
+        x_rel = (pos.x() - offset_x) / scale_x
+        y_rel = (pos.y() - offset_y) / scale_y
 
         return x_rel, y_rel
 
+    def _display_transform(self):
+        # Mapping from relative image coordinates to widget coordinates: widget = relative * scale + offset. The canvas
+        # covers the image label, with the zoom and center of the view
+        return self.parent().view_transform()
+
+    @traced('CanvasWidget.paintEvent')
     def paintEvent(self, event):
+        # The coordinate transform is computed once per paint
+        transform = self._display_transform()
+        segments = main_window.segments  # Use the segments stored in MainWindow
+        # The last segment is still being drawn while a stroke is in progress
+        finished = len(segments) - 1 if main_window.stroke_in_progress else len(segments)
+        self._update_layer(segments, finished, transform)
+
         painter = QPainter(self)
-        for color, thickness, points in main_window.segments:  # Use the segments stored in MainWindow
-            # Convert color from #RRGGBB format to QColor
-            color = QColor(color)
-            # Set opacity
-            color.setAlpha(self.parent().opacity)  # Get opacity from parent widget
-            # Set pen with modified color
-            painter.setPen(QPen(color, thickness, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
-
-            if points: # Check if the list is not empty
-                path = QPainterPath()
-                # Start the path at the first point
-                x_abs_start, y_abs_start = self._image_relative_to_widget_absolute(points[0])
-                path.moveTo(x_abs_start, y_abs_start)
-
-                # Continue the path through the rest of the points
-                for point_rel in points[1:]:
-                    x_abs, y_abs = self._image_relative_to_widget_absolute(point_rel)
-                    path.lineTo(x_abs, y_abs)
-
-                # Draw the path
-                painter.drawPath(path)
-
-    def _image_relative_to_widget_absolute(self, point_rel):
-        pixmap = self.parent().pixmap
-        image_label = self.parent().image_label
-
-        # Calculate scale factor between pixmap and label
-        scale_factor = min(image_label.width() / pixmap.width(), image_label.height() / pixmap.height())
-
-        # Calculate the empty space due to aspect ratio preservation
-        empty_space_x = (image_label.width() - scale_factor * pixmap.width()) / 2
-        empty_space_y = (image_label.height() - scale_factor * pixmap.height()) / 2
-
-        # Convert to absolute position
-        x_abs = point_rel[0] * scale_factor * pixmap.width() + empty_space_x
-        y_abs = point_rel[1] * scale_factor * pixmap.height() + empty_space_y
-
-        return x_abs, y_abs
-    
+        # Nothing is drawn around the image when the view is zoomed
+        painter.setClipRect(self.parent().viewport())
+        painter.drawPixmap(round(transform[2] - self._layer_origin[0]) - self._layer_margin[0],
+                           round(transform[3] - self._layer_origin[1]) - self._layer_margin[1], self._layer)
+        # Only the stroke in progress is drawn live
+        for segment in segments[finished:]:
+            self._draw_segment(painter, segment, transform)
+        # The selected segments are drawn again on top, over a dashed outline
+        if main_window.selected_ids:
+            for segment, segment_id in zip(segments, main_window.annotations.ids):
+                if segment_id in main_window.selected_ids:
+                    self._draw_segment(painter, segment, transform, outline=True)
+                    self._draw_segment(painter, segment, transform)
+        painter.end()
+        startup_profile.mark('first image painted')
+
+    def _update_layer(self, segments, finished, transform):
+        scale_x, scale_y, offset_x, offset_y = transform
+        key = (self.width(), self.height(), self.parent().opacity, scale_x, scale_y)
+        shift_x, shift_y = offset_x - self._layer_origin[0], offset_y - self._layer_origin[1]
+        if (self._layer is None or key != self._layer_key or segments is not self._layer_segments
+                or abs(shift_x) > self._layer_margin[0] or abs(shift_y) > self._layer_margin[1]):
+            # Start again from an empty layer, centered on the view
+            margin = ImageWidget.VIEW_MARGIN if self.parent().zoom != 1 else 0
+            self._layer_margin = (round(self.width() * margin), round(self.height() * margin))
+            self._layer_origin = (offset_x, offset_y)
+            self._layer = QPixmap(self.width() + 2 * self._layer_margin[0], self.height() + 2 * self._layer_margin[1])
+            self._layer.fill(Qt.transparent)
+            self._layer_key = key
+            self._layer_segments = segments
+            self._layer_last_id = -1
+            self._layer_dirty = []
+
+        ids = main_window.annotations.ids
+        layer_transform = (scale_x, scale_y, self._layer_origin[0] + self._layer_margin[0], self._layer_origin[1] + self._layer_margin[1])
+        drawn = bisect.bisect_right(ids, self._layer_last_id)  # Ids increase in drawing order
+        if drawn < finished:
+            # Draw only the segments finished since the last paint
+            painter = QPainter(self._layer)
+            for segment in segments[drawn:finished]:
+                self._draw_segment(painter, segment, layer_transform)
+            painter.end()
+            self._layer_last_id = ids[finished - 1]
+        if self._layer_dirty:
+            self._redraw_layer_area(segments, ids, finished, layer_transform)
+            self._layer_dirty = []
+
+    def _redraw_layer_area(self, segments, ids, finished, transform):
+        # Clear the areas of the removed or inserted segments, then draw again the finished segments crossing them in
+        # order. They are found by the spatial index, so the cost does not grow with the number of segments
+        scale_x, scale_y, offset_x, offset_y = transform
+        image_shape = self.parent().image_shape
+        region = QRegion()
+        boxes = []
+        for x_min, y_min, x_max, y_max, thickness in self._layer_dirty:
+            margin = int(thickness * scale_x / image_shape[1]) + 2
+            rect = QRectF(x_min * scale_x + offset_x, y_min * scale_y + offset_y, (x_max - x_min) * scale_x, (y_max - y_min) * scale_y)
+            rect = rect.toAlignedRect().adjusted(-margin, -margin, margin, margin).intersected(self._layer.rect())
+            if rect.isEmpty():
+                continue
+            region = region.united(rect)
+            boxes.append(((rect.left() - offset_x) / scale_x, (rect.top() - offset_y) / scale_y,
+                          (rect.right() + 1 - offset_x) / scale_x, (rect.bottom() + 1 - offset_y) / scale_y))
+        if region.isEmpty():
+            return
+        indices = sorted(bisect.bisect_left(ids, segment_id) for segment_id in main_window.annotations.segments_in(boxes, image_shape))
+        painter = QPainter(self._layer)
+        painter.setClipRegion(region)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        painter.fillRect(region.boundingRect(), Qt.transparent)
+        painter.setCompositionMode(QPainter.CompositionMode_SourceOver)
+        for index in indices:
+            if index < finished:
+                self._draw_segment(painter, segments[index], transform)
+        painter.end()
+
+    def invalidate_layer(self):
+        # Force the cached layer to be rebuilt on the next paint
+        self._layer = None
+        self.update()
+
+    def _draw_segment(self, painter, segment, transform, outline=False):
+        color, thickness, points = segment
+        if len(points) == 0:
+            return
+        # Convert color from #RRGGBB format to QColor
+        color = QColor(color)
+        # Set opacity
+        color.setAlpha(self.parent().opacity)  # Get opacity from parent widget
+        if thickness == rasterize.FILL_THICKNESS:
+            self._draw_region(painter, color, points, transform, outline)
+            return
+        # Set pen with modified color, the thickness is in image pixels but at least one pixel on screen
+        pen_width = max(thickness * transform[0] / self.parent().image_shape[1], 1)
+        if outline:
+            painter.setPen(QPen(Qt.white, pen_width + 4, Qt.DashLine, Qt.RoundCap, Qt.RoundJoin))
+        else:
+            painter.setPen(QPen(color, pen_width, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
+        painter.drawPolyline(self._to_widget_polygon(points, transform))
+
+    def _draw_region(self, painter, color, points, transform, outline):
+        # The outline of a region with its inside filled at half the opacity, with the even-odd rule of the export
+        polygon = self._to_widget_polygon(points, transform)
+        if outline:
+            painter.setPen(QPen(Qt.white, 5, Qt.DashLine, Qt.RoundCap, Qt.RoundJoin))
+            painter.drawPolygon(polygon)
+            return
+        fill = QColor(color)
+        fill.setAlpha(color.alpha() // 2)
+        painter.setPen(QPen(color, 1, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
+        painter.setBrush(fill)
+        painter.drawPolygon(polygon, Qt.OddEvenFill)
+        painter.setBrush(Qt.NoBrush)
+
+    def _to_widget_polygon(self, points, transform):
+        # Convert all the points of a segment at once
+        scale_x, scale_y, offset_x, offset_y = transform
+        points_abs = np.asarray(points, dtype=np.float64).reshape(-1, 2) * (scale_x, scale_y) + (offset_x, offset_y)
+        return QPolygonF([QPointF(x, y) for x, y in points_abs.tolist()])
+
+
 class FolderSelectionWindow(QWidget):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -576,15 +1711,6 @@ class FolderSelectionWindow(QWidget):
             self.proceed_button.setEnabled(True)
 
     def proceed(self):
-
-        def sort_files(file):
-            if 'sonar' in file:
-                return 0
-            elif 'bathy' in file:
-                return 1
-            elif 'tri' in file:
-                return 2
-        
         # get the base name (file name with extension) from the selected file path
         selected_file_basename = os.path.basename(self.folder1[0]) 
         # get the base name without extension
@@ -592,61 +1718,1358 @@ class FolderSelectionWindow(QWidget):
         # get the prefix of the selected file (before the last underscore)
         selected_file_prefix = "_".join(selected_file_base.split("_")[:-1])  
 
-        # get the directory of the selected file
+        # get the directory of the selected file and group its files by prefix, once for the whole session
         selected_file_dir = os.path.dirname(self.folder1[0])  
-        # get all files in the directory
-        all_files = os.listdir(selected_file_dir)  
-
-        # filter files with the same prefix and different suffix ('bathy', 'sonar', 'tri')
-        corresponding_files = [f for f in all_files if f.startswith(selected_file_prefix) and f.endswith(('.tif', '.npy'))]
-
-        # sort the files
-        corresponding_files.sort(key=sort_files)
-
-        # now corresponding_files[0] is 'bathy', corresponding_files[1] is 'sonar', and corresponding_files[2] is 'tri'
+        dataset = DatasetIndex(selected_file_dir)
+        if selected_file_prefix not in dataset.triplets:
+            QMessageBox.warning(self, 'Missing images', f'{selected_file_prefix} needs a sonar, a bathy and a tri image in {selected_file_dir}')
+            return
 
-        self.sonar_image = os.path.join(selected_file_dir, corresponding_files[0])
-        self.bathy_image = os.path.join(selected_file_dir, corresponding_files[1])
-        self.tri_image = os.path.join(selected_file_dir, corresponding_files[2])
-        
+        self.sonar_image, self.bathy_image, self.tri_image = dataset.triplet(selected_file_prefix)
 
         self.close()
+        wait_preload()
+        startup_profile.mark('folder selection (user)')
         global main_window
-        main_window = MainWindow(self.sonar_image, self.bathy_image, self.tri_image, self.folder2,selected_file_prefix)
+        main_window = MainWindow(self.sonar_image, self.bathy_image, self.tri_image, self.folder2,selected_file_prefix, dataset)
         main_window.show()
-        main_window.load()  # Load existing annotations
     
-def add_border(image, border_size=100):
-    # Create a border mask of ones with the same size as the image
-    border_mask = np.ones(image.shape, dtype=image.dtype)
-
-    # Calculate the coordinates for the border
-    start_y, start_x = (image.shape[0] - border_size) // 2, (image.shape[1] - border_size) // 2
-    end_y, end_x = start_y + border_size, start_x + border_size
-
-    # Set the border pixels in the mask to min or max depending on the mean
-    if np.mean(image) < 0.5:
-        border_mask[start_y:end_y, start_x] = 255  # Left border
-        border_mask[start_y:end_y, end_x] = 255  # Right border
-        border_mask[start_y, start_x:end_x] = 255  # Top border
-        border_mask[end_y, start_x:end_x] = 255  # Bottom border
+class StartupProfile:
+    # Durations of the startup phases, printed by --startup-profile once the first image is painted
+    def __init__(self):
+        self.enabled = False
+        self.phases = []
+        self.last = _startup_time
+        self.background = {}
+
+    def mark(self, phase):
+        # End of a phase, measured from the end of the previous one; repeated marks are ignored
+        if not self.enabled or any(name == phase for name, _ in self.phases):
+            return
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+        if phase == 'first image painted':
+            self.report()
+
+    def report(self):
+        print('Startup profile:')
+        for phase, duration in self.phases:
+            print(f'  {phase:<40} {duration * 1000:8.1f} ms')
+        for task, duration in self.background.items():
+            print(f'  {task + " (background)":<40} {duration * 1000:8.1f} ms')
+        self.enabled = False
+
+startup_profile = StartupProfile()
+_preload_thread = None
+
+def preload_modules():
+    # Import numpy and the rasterizer in a background thread while the user picks the files. The main window is only
+    # created once this is done, so the save worker and the GUI thread never execute a lazy module at the same time
+    global _preload_thread
+    def preload():
+        start = time.perf_counter()
+        np.ndarray  # The first attribute access executes the module
+        rasterize.FILL_THICKNESS
+        startup_profile.background['numpy import'] = time.perf_counter() - start
+    _preload_thread = threading.Thread(target=preload, daemon=True)
+    _preload_thread.start()
+
+def wait_preload():
+    # The lazy modules must not be executed by two threads at once
+    if _preload_thread is not None:
+        _preload_thread.join()
+
+# Display palettes as anchor points (position, (red, green, blue)), interpolated into 256-entry LUTs by colormap_lut
+COLORMAPS = {
+    'gray': [(0.0, (0.0, 0.0, 0.0)), (1.0, (1.0, 1.0, 1.0))],
+    'viridis': [(0.0000, (0.267, 0.005, 0.329)), (0.0625, (0.282, 0.095, 0.417)), (0.1250, (0.279, 0.175, 0.483)),
+                (0.1875, (0.259, 0.252, 0.525)), (0.2500, (0.230, 0.322, 0.546)), (0.3125, (0.199, 0.388, 0.555)),
+                (0.3750, (0.173, 0.449, 0.558)), (0.4375, (0.149, 0.508, 0.557)), (0.5000, (0.128, 0.567, 0.551)),
+                (0.5625, (0.121, 0.626, 0.533)), (0.6250, (0.158, 0.684, 0.502)), (0.6875, (0.246, 0.739, 0.452)),
+                (0.7500, (0.369, 0.789, 0.383)), (0.8125, (0.516, 0.831, 0.294)), (0.8750, (0.678, 0.864, 0.190)),
+                (0.9375, (0.846, 0.887, 0.100)), (1.0000, (0.993, 0.906, 0.144))],
+    'terrain': [(0.00, (0.2, 0.2, 0.6)), (0.15, (0.0, 0.6, 1.0)), (0.25, (0.0, 0.8, 0.4)), (0.50, (1.0, 1.0, 0.6)),
+                (0.75, (0.5, 0.36, 0.33)), (1.00, (1.0, 1.0, 1.0))],
+    'bathymetry': [(0.0, (0.03, 0.05, 0.25)), (0.35, (0.05, 0.25, 0.55)), (0.7, (0.2, 0.6, 0.8)), (1.0, (0.8, 0.97, 1.0))],
+}
+_colormap_luts = {}
+
+def colormap_lut(name):
+    # (256, 4) uint8 RGBA LUT of a palette of COLORMAPS, built on first use
+    lut = _colormap_luts.get(name)
+    if lut is None:
+        positions, colors = zip(*COLORMAPS[name])
+        colors = np.array(colors)
+        x = np.linspace(0, 1, 256)
+        lut = np.full((256, 4), 255, dtype=np.uint8)
+        for channel in range(3):
+            lut[:, channel] = np.rint(np.interp(x, positions, colors[:, channel]) * 255)
+        _colormap_luts[name] = lut
+    return lut
+
+_dataset_configs = {}  # Settings of the folders already read, keyed by (path, modification time)
+
+def dataset_config(folder):
+    # Settings of a folder of images read from its DATASET_CONFIG file, empty without one
+    path = os.path.join(os.path.abspath(folder), DATASET_CONFIG)
+    if not os.path.exists(path):
+        return {}
+    key = (path, os.stat(path).st_mtime_ns)
+    config = _dataset_configs.get(key)
+    if config is None:
+        with open(path, 'r') as f:
+            config = json.load(f)
+        _dataset_configs[key] = config
+    return config
+
+def class_priority(config):
+    # Overlap priority of the regions of each pencil color for the settings of a dataset
+    priority = dict(CLASS_PRIORITY)
+    for name, value in config.get('class_priority', {}).items():
+        if name not in CLASS_COLORS:
+            raise ValueError(f"Unknown class in class_priority: {name}")
+        priority[CLASS_COLORS[name]] = value
+    return priority
+
+# Tiles prepared in advance by the TilePrefetcher
+PREFETCH_CAPACITY = 4
+# Arrays already opened in this process, keyed by (absolute path, modification time), least recently used first.
+# Every memory map keeps a file descriptor open, so only the three images of the prefetched tiles and of the current
+# one are kept
+ARRAY_CACHE_SIZE = 3 * (PREFETCH_CAPACITY + 1)
+_array_cache = OrderedDict()
+_array_cache_lock = threading.Lock()  # The tiles are also loaded by the prefetch thread
+
+def load_array(path):
+    # Open each .npy file only once as a read-only memory map and share it between the widgets and transforms.
+    # The modification time is part of the key so a file rewritten on disk is opened again
+    path = os.path.abspath(path)
+    key = (path, os.stat(path).st_mtime_ns)
+    with _array_cache_lock:
+        array = _array_cache.pop(key, None)
+        if array is None:
+            # Forget older versions of the same file
+            for old_key in [k for k in _array_cache if k[0] == path]:
+                del _array_cache[old_key]
+            array = np.load(path, mmap_mode='r')
+        _array_cache[key] = array
+        while len(_array_cache) > ARRAY_CACHE_SIZE:
+            _array_cache.popitem(last=False)
+    return array
+
+class ImageData:
+    # An image decoded and indexed for display, without any Qt object so that it can be prepared in a worker thread
+    @traced('ImageData')
+    def __init__(self, path):
+        self.path = path
+        self.data = None
+        self.stats = None
+        self.pyramid = None
+        extension = os.path.splitext(path)[1].lower()
+        if extension == '.npy':
+            self.data = load_array(path)
+        elif extension in ('.tif', '.tiff'):
+            try:
+                self.data = TiffImage(path)
+            except ImportError:
+                pass  # Without tifffile, the TIFF files Qt can decode are still displayed
+        if self.data is not None:
+            if len(self.data.shape) == 2:
+                # Build the statistics and the downsamples once, the display only looks them up afterwards
+                if self.data.shape[0] * self.data.shape[1] > ImagePyramid.MAX_CACHED_PIXELS:
+                    self.stats, self.pyramid = index_large_image(self.data)
+                else:
+                    self.stats = QuantileIndex(self.data)
+                    self.pyramid = ImagePyramid(self.data, self.stats)
+            elif len(self.data.shape) != 3:
+                raise ValueError(f"Unsupported number of dimensions: {len(self.data.shape)}")
+            elif isinstance(self.data, TiffImage):
+                self.data = self.data[:, :]  # Color images are displayed whole
+            self.shape = self.data.shape[:2]
+        else:
+            # Other formats are read by Qt
+            size = QImageReader(path).size()
+            self.shape = (size.height(), size.width())
+        # Window of the image that is annotated, as (rows, columns)
+        config = dataset_config(os.path.dirname(path))
+        self.drawing_area = drawing_area_window(self.shape, config.get('drawing_area'))
+        self.class_priority = class_priority(config)  # Overlap priority of the regions of the dataset
+        # Percentiles of the modality over the dataset, precomputed by compute_dataset_statistics
+        self.global_percentiles = dataset_statistics(os.path.dirname(path)).get(image_modality(path))
+
+class DatasetIndex:
+    # The tiles of a folder, scanned once: every prefix with its sonar, bathy and tri images
+    MODALITIES = ('sonar', 'bathy', 'tri')
+
+    def __init__(self, directory):
+        self.directory = directory
+        triplets = {}
+        for name in os.listdir(directory):
+            base, extension = os.path.splitext(name)
+            if extension.lower() not in ('.npy', '.tif', '.tiff') or '_' not in base:
+                continue
+            prefix, suffix = base.rsplit('_', 1)
+            if suffix.lower() in self.MODALITIES:
+                triplets.setdefault(prefix, {})[suffix.lower()] = os.path.join(directory, name)
+        self._files = triplets
+        # Only the complete triplets can be annotated
+        self.triplets = {prefix: tuple(files[modality] for modality in self.MODALITIES)
+                         for prefix, files in triplets.items() if len(files) == len(self.MODALITIES)}
+        self.prefixes = sorted(self.triplets)
+
+    def triplet(self, prefix):
+        # (sonar, bathy, tri) image paths
+        return self.triplets[prefix]
+
+    def image(self, prefix):
+        # One of the images of a tile, complete or not, None when it has none. They all have the shape of its labels
+        files = self._files.get(prefix)
+        return files[min(files)] if files else None
+
+    def next(self, prefix):
+        index = self.prefixes.index(prefix)
+        return self.prefixes[index + 1] if index + 1 < len(self.prefixes) else None
+
+    def previous(self, prefix):
+        index = self.prefixes.index(prefix)
+        return self.prefixes[index - 1] if index > 0 else None
+
+class TilePrefetcher:
+    # Prepares the images of tiles in a background thread and keeps the last ones in a bounded LRU cache
+    def __init__(self, dataset, capacity=PREFETCH_CAPACITY):
+        self.dataset = dataset
+        self.capacity = capacity
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._futures = OrderedDict()  # prefix -> future of the (sonar, bathy, tri) ImageData, most recent last
+
+    def get(self, prefix):
+        # The prepared images of a tile, waits for them if they are still being prepared
+        return self._request(prefix).result()
+
+    def prefetch(self, prefixes):
+        # Start preparing the given tiles
+        for prefix in prefixes:
+            if prefix is not None:
+                self._request(prefix)
+
+    def _request(self, prefix):
+        future = self._futures.pop(prefix, None)
+        if future is None:
+            future = self._executor.submit(lambda: tuple(ImageData(path) for path in self.dataset.triplet(prefix)))
+        self._futures[prefix] = future
+        while len(self._futures) > self.capacity:
+            _, evicted = self._futures.popitem(last=False)
+            evicted.cancel()
+        return future
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+class ImagePyramid:
+    # Power-of-two downsamples of an image, built once. Every level is the 2x2 mean of the previous one, stored as
+    # bins of the QuantileIndex of the image so that the display LUTs apply to any level.
+    # The levels of large images above MAX_CACHED_PIXELS are not kept (None): their regions are decoded from the
+    # data when rendered, see index_large_image
+    MIN_SIZE = 256  # No level smaller than this
+    CHUNK_ROWS = 2048  # Rows averaged at once, to bound the memory used when building from a memory map
+    MAX_CACHED_PIXELS = 1 << 24  # Largest level kept in memory
+    BLOCK_PIXELS = 1 << 24  # Pixels read at once by index_large_image
+
+    def __init__(self, data, stats, first_level=None):
+        # first_level is (index, float32 values) of the first level kept, by default the full resolution image
+        self.shape = data.shape[:2]  # Shape of the full resolution image
+        self.data = data
+        self.stats = stats
+        self._histogram = None
+        if first_level is None:
+            self.levels = [stats.codes]
+            level = data
+        else:
+            index, level = first_level
+            self.levels = [None] * index + [stats.encode(level)]
+        while min(level.shape) >= 2 * self.MIN_SIZE:
+            level = self._downsample(level)
+            self.levels.append(stats.encode(level))
+
+    def _downsample(self, data):
+        height, width = data.shape[0] // 2 * 2, data.shape[1] // 2 * 2
+        downsampled = np.empty((height // 2, width // 2), dtype=np.float32)
+        for row in range(0, height, self.CHUNK_ROWS):
+            block = np.asarray(data[row:min(row + self.CHUNK_ROWS, height), :width], dtype=np.float32)
+            downsampled[row // 2:row // 2 + block.shape[0] // 2] = block.reshape(block.shape[0] // 2, 2, width // 2, 2).mean(axis=(1, 3))
+        return downsampled
+
+    def level_for(self, width, height, rows=None, cols=None):
+        # Smallest level that still has at least width x height pixels in the given region (full resolution rows and
+        # columns, the whole image by default)
+        rows = rows if rows is not None else slice(0, self.shape[0])
+        cols = cols if cols is not None else slice(0, self.shape[1])
+        level = 0
+        while (level + 1 < len(self.levels) and (rows.stop - rows.start) >> (level + 1) >= height
+               and (cols.stop - cols.start) >> (level + 1) >= width):
+            level += 1
+        return level
+
+    def render(self, level, lut, rows=None, cols=None, out=None):
+        # Apply a display LUT (gray or RGBA) to a region of a level, only the pixels of the region are decoded.
+        # out is reused when it has the shape of the result
+        codes = self.levels[level]
+        if codes is None:
+            codes = self._decode(level, rows, cols)
+        else:
+            if rows is not None:
+                codes = codes[rows.start >> level:-(-rows.stop >> level)]
+            if cols is not None:
+                codes = codes[:, cols.start >> level:-(-cols.stop >> level)]
+        if out is None or out.shape != codes.shape + lut.shape[1:]:
+            out = np.empty(codes.shape + lut.shape[1:], dtype=lut.dtype)
+        # By blocks of rows, np.take converts the codes to intp. mode='raise' would buffer out
+        for row in range(0, codes.shape[0], self.CHUNK_ROWS // 8):
+            np.take(lut, codes[row:row + self.CHUNK_ROWS // 8], axis=0, out=out[row:row + self.CHUNK_ROWS // 8], mode='clip')
+        return out
+
+    def histogram(self):
+        # Number of pixels of every code in the coarsest level, enough to tell dark images from bright ones
+        if self._histogram is None:
+            self._histogram = np.bincount(self.levels[-1].reshape(-1), minlength=self.stats.nan_code + 1)
+        return self._histogram
+
+    def _decode(self, level, rows, cols):
+        # Codes of a region of a level that is not kept, averaged from the data or its closest overview
+        rows = rows if rows is not None else slice(0, self.shape[0])
+        cols = cols if cols is not None else slice(0, self.shape[1])
+        first_row, last_row = rows.start >> level, min(-(-rows.stop >> level), self.shape[0] >> level)
+        first_col, last_col = cols.start >> level, min(-(-cols.stop >> level), self.shape[1] >> level)
+        source, source_factor = overview_of(self.data, 1 << level)
+        factor = (1 << level) // source_factor
+        block = np.asarray(source[first_row * factor:last_row * factor, first_col * factor:last_col * factor], dtype=np.float32)
+        if factor > 1:
+            block = block.reshape(last_row - first_row, factor, last_col - first_col, factor).mean(axis=(1, 3))
+        return self.stats.encode(block)
+
+class QuantileIndex:
+    # Statistics of an image computed once at load time, so that the display sliders never sort the data again.
+    # The pixels are binned on the percentiles of the data (so every slider position is an exact bin edge) refined
+    # by a uniform grid over the value range (so the bins stay thin in the tails), and clipping/normalizing the
+    # image becomes a lookup in a 8-bit LUT over the bins.
+    # The log transform is monotonic, so the same bins also index the log-transformed data.
+    BINS_PER_PERCENT = 20
+    UNIFORM_BINS = 4096
+    SAMPLE_SIZE = 1 << 22  # Above this number of pixels the percentiles are estimated on a random sample
+
+    def __init__(self, data, value_range=None, encode=True):
+        # With value_range, data is only a sample of the image whose (min, max) is given.
+        # Without encode, the pixels are not binned and codes is None
+        values = np.asarray(data, dtype=np.float32).reshape(-1)
+        finite = np.isfinite(values)
+        all_finite = finite.all()
+        sample = values if all_finite else values[finite]
+        if sample.size == 0:
+            sample = np.zeros(1, dtype=np.float32)
+        if value_range is not None:
+            self.min, self.max = float(value_range[0]), float(value_range[1])
+        else:
+            self.min = float(np.min(sample))
+            self.max = float(np.max(sample))
+        if sample.size > self.SAMPLE_SIZE:
+            rng = np.random.default_rng(0)
+            sample = sample[rng.integers(0, sample.size, self.SAMPLE_SIZE)]
+
+        # Bin edges, edges[percentile_codes[k]] is the k-th percentile
+        percentiles = np.percentile(sample, np.linspace(0, 100, 100 * self.BINS_PER_PERCENT + 1))
+        percentiles[0], percentiles[-1] = self.min, self.max
+        percentiles = np.maximum.accumulate(percentiles)
+        self.edges = np.unique(np.concatenate([percentiles, np.linspace(self.min, self.max, self.UNIFORM_BINS + 1)]))
+        self.percentile_codes = np.searchsorted(self.edges, percentiles[::self.BINS_PER_PERCENT])
+
+        # Bin of every pixel, the bin k holds the values in [edges[k], edges[k + 1]) and the last one the maximum.
+        # Non finite values get their own bin after it
+        self.nan_code = self.edges.size
+        self.codes = self.encode(values, finite).reshape(data.shape) if encode else None
+
+    def encode(self, values, finite=None):
+        # Bins of an array of values
+        values = np.asarray(values, dtype=np.float32)
+        codes = np.searchsorted(self.edges[1:], values, side='right').astype(np.uint16)
+        finite = np.isfinite(values) if finite is None else finite
+        if not finite.all():
+            codes[~finite] = self.nan_code
+        return codes
+
+class TiffImage:
+    # Read-only array over the first image of a TIFF file that decodes only the strips or tiles of the rows and
+    # columns asked for, or maps the file when the image is stored uncompressed in one piece. The overviews of
+    # pyramidal TIFFs (e.g. cloud optimized GeoTIFFs) are found by overview(). The GDAL nodata value reads as NaN
+    _decoders = None  # Thread pool shared by all the files
+
+    def __init__(self, path, level=0, parent=None):
+        import tifffile  # Only the TIFF inputs need it
+        self.path = path
+        self.level = level
+        self._tiff = parent._tiff if parent is not None else tifffile.TiffFile(path)
+        self._lock = parent._lock if parent is not None else threading.Lock()  # Reads move the shared file position
+        self._levels = parent._levels if parent is not None else {0: self}
+        self._page = self._tiff.series[0].levels[level].keyframe
+        self.shape = tuple(self._page.shape)
+        self.ndim = len(self.shape)
+        # Only a GDAL_NODATA tag marks missing values, the images without one keep their type and values
+        nodata_tag = self._page.tags.get('GDAL_NODATA')
+        self.nodata = float(str(nodata_tag.value).strip('\x00 ')) if nodata_tag is not None else None
+        self.dtype = np.dtype(np.float32) if self.nodata is not None else self._page.dtype
+        if self.ndim not in (2, 3) or self._page.planarconfig != 1 and self.ndim == 3:
+            raise ValueError(f"Unsupported TIFF layout: {self.shape}")
+        self._memmap = None
+        if self._page.is_memmappable:
+            self._memmap = tifffile.memmap(path, series=0, level=level, mode='r')
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[:, :], dtype=dtype)
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        if len(key) > 2 or not all(isinstance(k, slice) for k in key):
+            raise IndexError("Only row and column slices are supported")
+        rows, cols = (key + (slice(None),) * 2)[:2]
+        rows = range(self.shape[0])[rows]
+        cols = range(self.shape[1])[cols]
+        if rows.step != 1 or cols.step != 1:
+            raise IndexError("Only contiguous windows are supported")
+        if self._memmap is not None:
+            window = np.array(self._memmap[rows.start:rows.stop, cols.start:cols.stop])
+        else:
+            window = self._read_window(rows.start, rows.stop, cols.start, cols.stop)
+        if self.nodata is not None:
+            window = window.astype(np.float32)
+            window[window == self.nodata] = np.nan
+        return window
+
+    def _read_window(self, first_row, last_row, first_col, last_col):
+        # Decode the strips or tiles that intersect the window, missing ones (sparse files) read as zeros
+        page = self._page
+        window = np.zeros((last_row - first_row, last_col - first_col) + self.shape[2:], dtype=page.dtype)
+        if window.size == 0:
+            return window
+        chunk_rows, chunk_cols = page.chunks[:2]
+        grid_cols = page.chunked[1]
+        segments = []
+        with self._lock:
+            for grid_row in range(first_row // chunk_rows, (last_row - 1) // chunk_rows + 1):
+                for grid_col in range(first_col // chunk_cols, (last_col - 1) // chunk_cols + 1):
+                    index = grid_row * grid_cols + grid_col
+                    if page.databytecounts[index] > 0:
+                        self._tiff.filehandle.seek(page.dataoffsets[index])
+                        segments.append((grid_row, grid_col, index, self._tiff.filehandle.read(page.databytecounts[index])))
+
+        def decode(segment):
+            # The decompressors release the GIL, the segments are decoded in parallel
+            grid_row, grid_col, index, encoded = segment
+            decoded = page.decode(encoded, index, jpegtables=page.jpegtables)[0][0]
+            if self.ndim == 2:
+                decoded = decoded[..., 0]
+            # Edge segments are padded to the full segment size
+            row, col = grid_row * chunk_rows, grid_col * chunk_cols
+            top, bottom = max(first_row, row), min(last_row, row + chunk_rows, self.shape[0])
+            left, right = max(first_col, col), min(last_col, col + chunk_cols, self.shape[1])
+            window[top - first_row:bottom - first_row, left - first_col:right - first_col] = \
+                decoded[top - row:bottom - row, left - col:right - col]
+        if len(segments) > 1:
+            if TiffImage._decoders is None:
+                TiffImage._decoders = ThreadPoolExecutor(max_workers=os.cpu_count())
+            list(TiffImage._decoders.map(decode, segments))
+        else:
+            for segment in segments:
+                decode(segment)
+        return window
+
+    def overview(self, factor):
+        # The coarsest level of the file downsampled by a power of two dividing factor, with its downsampling.
+        # Overviews are rounded up, so they always cover the pixels of the full resolution level divided by factor
+        best = (self, 1)
+        height, width = self.shape[:2]
+        for level in range(1, len(self._tiff.series[0].levels)):
+            shape = self._tiff.series[0].levels[level].shape
+            level_factor = 1 << round(math.log2(max(height / shape[0], 1)))
+            if (level_factor > best[1] and factor % level_factor == 0 and shape[0] >= height // level_factor
+                    and shape[1] >= width // level_factor and shape[2:] == self.shape[2:]):
+                if level not in self._levels:
+                    self._levels[level] = TiffImage(self.path, level, self)
+                best = (self._levels[level], level_factor)
+        return best
+
+def overview_of(data, factor):
+    # A source of the image downsampled by factor, with the downsampling it already has
+    return data.overview(factor) if isinstance(data, TiffImage) else (data, 1)
+
+def index_large_image(data):
+    # Quantile index and pyramid of an image too large to be encoded at full resolution, in a single pass over
+    # blocks of rows: the statistics come from a sample of every block (of the closest overview of pyramidal TIFFs)
+    # and the first level kept in memory is the first with at most ImagePyramid.MAX_CACHED_PIXELS pixels.
+    # The finer levels are decoded when displayed
+    height, width = data.shape[:2]
+    first = 0
+    while (height >> first) * (width >> first) > ImagePyramid.MAX_CACHED_PIXELS:
+        first += 1
+    source, source_factor = overview_of(data, 1 << first)
+    factor = (1 << first) // source_factor  # Downsampling left to do on the source
+    rows, cols = height >> first, width >> first
+    level = np.empty((rows, cols), dtype=np.float32)
+    sample_rate = QuantileIndex.SAMPLE_SIZE / (rows * cols * factor * factor)
+    rng = np.random.default_rng(0)
+    samples = []
+    minimum, maximum = math.inf, -math.inf
+    block_rows = max(ImagePyramid.BLOCK_PIXELS // (cols * factor * factor), 1) * factor
+    for row in range(0, rows * factor, block_rows):
+        block = np.asarray(source[row:min(row + block_rows, rows * factor), :cols * factor], dtype=np.float32)
+        finite = block[np.isfinite(block)]
+        if finite.size:
+            minimum, maximum = min(minimum, float(finite.min())), max(maximum, float(finite.max()))
+            count = min(finite.size, max(round(finite.size * sample_rate), 1))
+            samples.append(finite[rng.integers(0, finite.size, count)] if count < finite.size else finite)
+        if factor > 1:
+            block = block.reshape(block.shape[0] // factor, factor, cols, factor).mean(axis=(1, 3))
+        level[row // factor:row // factor + block.shape[0]] = block
+    sample = np.concatenate(samples) if samples else np.zeros(1, dtype=np.float32)
+    if not samples:
+        minimum = maximum = 0.0
+    stats = QuantileIndex(sample, value_range=(minimum, maximum), encode=False)
+    return stats, ImagePyramid(data, stats, (first, level))
+
+class QuantileSketch:
+    # Mergeable streaming quantile sketch (KLL): the level h keeps a sample of the values, each standing for 2**h of
+    # them. A level over its capacity is sorted and every other value, from a random start, moves up a level.
+    # The capacities shrink geometrically below the top level, so the memory is about 3k values whatever the number
+    # of values added, and the rank error is around 1/k. Sketches of parts of the data merge into a sketch of it all
+    K = 2048
+
+    def __init__(self, k=K, seed=0):
+        self.k = k
+        self.levels = [np.empty(0, dtype=np.float32)]
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self._rng = np.random.default_rng(seed)
+
+    def add(self, values):
+        # Add an array of values, the non finite ones are ignored
+        values = np.asarray(values, dtype=np.float32).reshape(-1)
+        values = values[np.isfinite(values)]
+        if values.size == 0:
+            return
+        self.count += values.size
+        self.min, self.max = min(self.min, float(values.min())), max(self.max, float(values.max()))
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+
+    def merge(self, other):
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0, dtype=np.float32))
+        for level, values in enumerate(other.levels):
+            self.levels[level] = np.concatenate([self.levels[level], values])
+        self.count += other.count
+        self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+        self._compress()
+
+    def _capacity(self, level):
+        return max(int(self.k * (2 / 3) ** (len(self.levels) - 1 - level)), 2)
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            values = self.levels[level]
+            if values.size > self._capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0, dtype=np.float32))
+                values = np.sort(values)
+                # An odd value out stays at this level
+                kept = values.size % 2
+                promoted = values[kept + int(self._rng.integers(2))::2]
+                self.levels[level] = values[:kept]
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+            level += 1
+
+    def quantiles(self, fractions):
+        # Values at the given fractions (0 to 1) of the data, the extremes are exact
+        fractions = np.asarray(fractions, dtype=np.float64)
+        if self.count == 0:
+            return np.full(fractions.shape, np.nan)
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(level.size, 2.0 ** h) for h, level in enumerate(self.levels)])
+        order = np.argsort(values, kind='stable')
+        values, cumulative = values[order], np.cumsum(weights[order])
+        ranks = fractions * cumulative[-1]
+        result = values[np.minimum(np.searchsorted(cumulative, ranks, side='left'), values.size - 1)].astype(np.float64)
+        result[fractions <= 0] = self.min
+        result[fractions >= 1] = self.max
+        return result
+
+class DisplayPipeline:
+    # Display transforms of a single band image, declared as a chain of stages evaluated on the bin values of its
+    # QuantileIndex instead of the pixels: the output is the LUT applied to the codes of the pyramid levels (8-bit
+    # gray, or RGBA with a palette). Every stage keeps its last outputs keyed by the parameters of the stages up to
+    # it, so changing a parameter only recomputes from the stage that uses it onward
+    STAGES = (('log', ('log',)), ('clip', ('quantile', 'normalization')), ('gamma', ('gamma',)), ('normalize', ()), ('colormap', ('colormap',)))
+    CACHE_SIZE = 32  # Outputs kept per stage
+
+    def __init__(self, stats, global_percentiles=None, **params):
+        # global_percentiles are the 0th..100th percentiles of the modality over the dataset, if computed
+        self.stats = stats
+        self.global_percentiles = global_percentiles
+        self.params = {'log': False, 'quantile': 100, 'normalization': 'tile', 'gamma': 1.0, 'colormap': 'gray'}
+        self.params.update(params)
+        self._values = stats.edges.astype(np.float32)
+        self._cache = {name: OrderedDict() for name, _ in self.STAGES}
+
+    def set(self, **params):
+        self.params.update(params)
+
+    def lut(self, until=None):
+        # Output of the chain, or of the stage named until
+        table = self._values
+        key = ()
+        for name, uses in self.STAGES:
+            key += tuple(self.params[param] for param in uses)
+            cache = self._cache[name]
+            output = cache.get(key)
+            if output is None:
+                output = cache[key] = getattr(self, '_' + name)(table)
+                if len(cache) > self.CACHE_SIZE:
+                    cache.popitem(last=False)
+            else:
+                cache.move_to_end(key)
+            table = output
+            if name == until:
+                break
+        return table
+
+    def _log(self, table):
+        # Adding a small constant to avoid log(0), the bins stay ordered since the log is monotonic
+        if not self.params['log']:
+            return table
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.log(table + np.float32(1e-9))
+
+    def _clip(self, table):
+        # Clip to [0th percentile, slider percentile] and rescale to 0-1, non finite values give 0. The percentiles
+        # are those of the image, or of the dataset with the global normalization
+        if self.params['normalization'] == 'global' and self.global_percentiles is not None:
+            percentiles = self._log(self.global_percentiles)
+            low_values, high = percentiles, percentiles[self.params['quantile']]
+        else:
+            low_values, high = table, table[self.stats.percentile_codes[self.params['quantile']]]
+        valid = np.isfinite(low_values)
+        if not valid.any():
+            return np.zeros_like(table)
+        low = low_values[valid][0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scaled = (table - low) / (high - low)
+        return np.nan_to_num(np.clip(scaled, 0, 1), nan=0, posinf=0, neginf=0)
+
+    def _gamma(self, table):
+        if self.params['gamma'] == 1:
+            return table
+        return table ** np.float32(self.params['gamma'])
+
+    def _normalize(self, table):
+        # 8-bit values, with the bin of the non finite pixels (QuantileIndex.nan_code) after the others at 0
+        lut = np.zeros(table.size + 1, dtype=np.uint8)
+        lut[:table.size] = table * 255
+        return lut
+
+    def _colormap(self, table):
+        if self.params['colormap'] == 'gray':
+            return table
+        return colormap_lut(self.params['colormap'])[table]
+
+    def mean(self, histogram):
+        # Mean 8-bit gray value of the pixels counted by a histogram of the codes
+        return float(np.dot(histogram, self.lut('normalize'))) / max(int(histogram.sum()), 1)
+
+
+def simplify_points(points, tolerance, shape):
+    # Ramer-Douglas-Peucker simplification of a stroke in relative coordinates, the tolerance is in image pixels.
+    # Distances are measured to the chord as a segment, not a line, so the turning points of back and forth strokes are kept
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if len(points) < 3 or tolerance <= 0:
+        return [tuple(point) for point in points.tolist()]
+    height, width = shape[:2]
+    pixels = points * (width, height)
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start = pixels[first]
+        chord = pixels[last] - start
+        inner = pixels[first + 1:last] - start
+        chord_length2 = chord @ chord
+        t = np.clip(inner @ chord / chord_length2, 0, 1) if chord_length2 > 0 else np.zeros(len(inner))
+        distances = np.hypot(*(inner - t[:, None] * chord).T)
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = first + 1 + farthest
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return [tuple(point) for point in points[keep].tolist()]
+
+def simplify_segments(segments, tolerance, shape):
+    return [(color, thickness, simplify_points(points, tolerance, shape)) for color, thickness, points in segments]
+
+class SegmentIndex:
+    # Uniform grid over the relative image coordinates, listing in each cell the pieces (pairs of consecutive
+    # points) of the segments whose bounding box covers it. Most pieces are kept in arrays sorted by cell, built
+    # at once, and the pieces added afterwards in a dictionary. Removed or reshaped segments leave stale entries
+    # that the exact distance test discards, until the arrays are rebuilt
+    GRID_SIZE = 128
+
+    def __init__(self):
+        self.rebuild([], [])
+
+    def rebuild(self, ids, segments):
+        self.segments = {segment_id: (thickness, points) for segment_id, (_, thickness, points) in zip(ids, segments)}
+        self._rebuild()
+
+    def _rebuild(self):
+        arrays = [np.asarray(points, dtype=np.float64).reshape(-1, 2) for _, points in self.segments.values()]
+        points = np.concatenate(arrays) if arrays else np.zeros((0, 2))
+        lengths = np.array([len(array) for array in arrays], dtype=np.int64)
+        ends = np.cumsum(lengths)
+        # A single point is a piece of length zero
+        counts = np.maximum(lengths - 1, np.minimum(lengths, 1))
+        ids = np.repeat(np.fromiter(self.segments.keys(), dtype=np.int64, count=len(arrays)), counts)
+        pieces = np.arange(len(ids)) - np.repeat(np.cumsum(counts) - counts, counts)  # Index of each piece in its segment
+        first = np.repeat(ends - lengths, counts) + pieces
+        last = np.minimum(first + 1, np.repeat(ends - 1, counts))
+        cells, rows = self._piece_cells(points[first], points[last])
+        order = np.argsort(cells, kind='stable')
+        self._cells = cells[order]
+        self._entries = np.stack([ids[rows][order], pieces[rows][order]], axis=1)
+        self._added = {}  # Cell -> list of (segment id, piece index)
+        self._added_count = 0
+        self._max_thickness = max((thickness for thickness, _ in self.segments.values()), default=0)
+        # Bounding box of every region, whose inside has no piece in the grid
+        self._regions = {segment_id: self._bounds(points) for segment_id, (thickness, points) in self.segments.items() if thickness == rasterize.FILL_THICKNESS}
+
+    def add(self, segment_id, thickness, points, first_piece=0):
+        # Register a new or changed segment, only the pieces from first_piece on are inserted
+        self.segments[segment_id] = (thickness, points)
+        self._max_thickness = max(self._max_thickness, thickness)
+        if thickness == rasterize.FILL_THICKNESS:
+            box = self._bounds(points[first_piece:])
+            if first_piece and segment_id in self._regions:
+                box = (*map(min, self._regions[segment_id][:2], box[:2]), *map(max, self._regions[segment_id][2:], box[2:]))
+            self._regions[segment_id] = box
+        first, last = self._pieces(points[first_piece:])
+        cells, rows = self._piece_cells(first, last)
+        for cell, row in zip(cells.tolist(), rows.tolist()):
+            self._added.setdefault(cell, []).append((segment_id, first_piece + row))
+        self._added_count += len(cells)
+        if self._added_count > max(len(self._cells), 10000):
+            self._rebuild()
+
+    def remove(self, segment_id):
+        self.segments.pop(segment_id, None)
+        self._regions.pop(segment_id, None)
+
+    def hits(self, x_rel, y_rel, radius, shape):
+        # Ids of the segments passing within radius image pixels of the point, given the shape of the image
+        height, width = shape[:2]
+        reach = radius + self._max_thickness / 2
+        n = self.GRID_SIZE
+        x_first, x_last = (int(min(max(x * n, 0), n - 1)) for x in (x_rel - reach / width, x_rel + reach / width))
+        y_first, y_last = (int(min(max(y * n, 0), n - 1)) for y in (y_rel - reach / height, y_rel + reach / height))
+        candidates = set()
+        for y in range(y_first, y_last + 1):
+            # The cells of a grid row are contiguous in the sorted arrays
+            start = np.searchsorted(self._cells, y * n + x_first)
+            end = np.searchsorted(self._cells, y * n + x_last, 'right')
+            candidates.update(map(tuple, self._entries[start:end].tolist()))
+            for x in range(x_first, x_last + 1):
+                candidates.update(self._added.get(y * n + x, ()))
+        hits = set()
+        for segment_id, piece in candidates:
+            if segment_id in hits or segment_id not in self.segments:
+                continue
+            thickness, points = self.segments[segment_id]
+            if piece >= len(points):
+                continue
+            # Distance in image pixels from the point to the piece
+            x0, y0 = points[piece]
+            x1, y1 = points[min(piece + 1, len(points) - 1)]
+            dx, dy = (x1 - x0) * width, (y1 - y0) * height
+            px, py = (x_rel - x0) * width, (y_rel - y0) * height
+            length2 = dx * dx + dy * dy
+            t = min(max((px * dx + py * dy) / length2, 0), 1) if length2 > 0 else 0
+            if math.hypot(px - t * dx, py - t * dy) <= radius + thickness / 2:
+                hits.add(segment_id)
+        return hits
+
+    def segments_in(self, boxes, shape):
+        # Ids of the segments that may cross rectangles (x_min, y_min, x_max, y_max) of relative coordinates, given the
+        # shape of the image: those with a piece in the cells around them, within their thickness, and the regions whose
+        # bounding box meets one. Every cell is visited once, however many rectangles cover it
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        reach = self._max_thickness / 2 / np.array([shape[1], shape[0]], dtype=np.float64)
+        cells = np.unique(self._box_cells(boxes[:, :2] - reach, boxes[:, 2:] + reach)[0])
+        # The entries of a cell are contiguous in the sorted arrays
+        starts = np.searchsorted(self._cells, cells)
+        counts = np.searchsorted(self._cells, cells, 'right') - starts
+        rows = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+        found = set(np.unique(self._entries[rows, 0]).tolist())
+        for cell in cells.tolist():
+            found.update(segment_id for segment_id, _ in self._added.get(cell, ()))
+        if self._regions:
+            regions = np.array(list(self._regions.values()), dtype=np.float64)
+            meets = ((regions[:, None, 0] <= boxes[None, :, 2]) & (boxes[None, :, 0] <= regions[:, None, 2])
+                     & (regions[:, None, 1] <= boxes[None, :, 3]) & (boxes[None, :, 1] <= regions[:, None, 3])).any(axis=1)
+            found.update(segment_id for segment_id, meet in zip(self._regions, meets.tolist()) if meet)
+        # Removed segments leave stale entries
+        return found.intersection(self.segments)
+
+    def _bounds(self, points):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        return (*points.min(axis=0).tolist(), *points.max(axis=0).tolist())
+
+    def _pieces(self, points):
+        # First and last point of each piece, a single point is a piece of length zero
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        if len(points) == 1:
+            return points, points
+        return points[:-1], points[1:]
+
+    def _piece_cells(self, first, last):
+        # Cells covered by each piece, with the row of the piece they come from. Long pieces are cut into parts
+        # of at most one cell, so that a diagonal only covers the cells along it instead of its whole bounding box
+        n = self.GRID_SIZE
+        parts = np.maximum(np.ceil(np.abs(last - first).max(axis=1, initial=0) * n), 1).astype(np.int64)
+        rows = np.repeat(np.arange(len(first)), parts)
+        part = np.arange(len(rows)) - np.repeat(np.cumsum(parts) - parts, parts)
+        step = ((last - first) / parts[:, None])[rows]
+        part_first = first[rows] + part[:, None] * step
+        part_last = part_first + step
+        cells, part_rows = self._box_cells(np.minimum(part_first, part_last), np.maximum(part_first, part_last))
+        return cells, rows[part_rows]
+
+    def _box_cells(self, low, high):
+        # Cells covered by boxes, with the row of the box they come from
+        n = self.GRID_SIZE
+        low = np.clip(np.floor(low * n), 0, n - 1).astype(np.int64)
+        high = np.clip(np.floor(high * n), 0, n - 1).astype(np.int64)
+        widths = high[:, 0] - low[:, 0] + 1
+        counts = widths * (high[:, 1] - low[:, 1] + 1)
+        rows = np.repeat(np.arange(len(low)), counts)
+        offsets = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+        x = low[rows, 0] + offsets % widths[rows]
+        y = low[rows, 1] + offsets // widths[rows]
+        return y * n + x, rows
+
+@traced('write_annotation_outputs')
+def write_annotation_outputs(segments, shape, window, output_path, annot_path, class_priority=CLASS_PRIORITY):
+    # Rasterize the segments and write the label matrix and the annotations, runs in the save worker thread
+    export_labels(segments, shape, window, output_path, class_priority)
+    save_annotations(annot_path, segments)
+
+    return output_path
+
+def export_labels(segments, shape, window, output_path, class_priority=CLASS_PRIORITY):
+    # Rasterize the segments in the drawing area window and write the label matrix, returns the labels.
+    # The output keeps the float format of the previous versions
+    labels = rasterize.rasterize_segments(segments, shape, CLASS_LABELS, class_priority, window=window)
+    write_atomic(output_path, lambda f: np.save(f, labels.astype(np.float64)))
+    return labels
+
+EXPORT_MANIFEST = '.export_manifest.json'  # Export key of every label matrix written by export_folder
+
+def export_folder(output_folder, image_folder, workers=None, force=False, mosaic_path=None):
+    # Re-export the label matrix of every annotation file in output_folder, without any window.
+    # A tile is skipped when its label matrix exists and was exported from the same annotations and settings.
+    # With mosaic_path, the labels of every tile are also written at their place in a survey-wide .npy memory map,
+    # which is created when missing (all the tiles are exported into it then)
+    start = time.perf_counter()
+    config = dataset_config(image_folder)
+    priority = class_priority(config)
+    dataset = DatasetIndex(image_folder)  # The image folder is listed once for all the tiles
+    manifest_path = os.path.join(output_folder, EXPORT_MANIFEST)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+
+    suffix_length = len('_annot')
+    prefixes = sorted(set(os.path.splitext(name)[0][:-suffix_length] for name in os.listdir(output_folder)
+                          if name.endswith(('_annot.npz', '_annot.json'))))
+
+    entries, tiles, skipped, failed = [], [], 0, []
+    for prefix in prefixes:
+        annot_path = find_annotation_file(output_folder, prefix)
+        output_path = os.path.join(output_folder, prefix + '_output.npy')
+        image_path = dataset.image(prefix)
+        if image_path is None:
+            failed.append((prefix, 'no image found in ' + image_folder))
+            continue
+        shape = image_shape(image_path)
+        window = drawing_area_window(shape, config.get('drawing_area'))
+        place = None  # Mosaic path and (row, column) of the window in the mosaic
+        if mosaic_path is not None:
+            offset = tile_offset(prefix, config.get('mosaic', {}))
+            if offset is None:
+                failed.append((prefix, 'no mosaic offset in ' + os.path.join(image_folder, DATASET_CONFIG)))
+                continue
+            place = (mosaic_path, (offset[0] + window[0].start, offset[1] + window[1].start))
+        entries.append((prefix, annot_path, image_path, shape, window, output_path, place))
+    if mosaic_path is not None and entries:
+        # The mosaic starts at the first drawing area rather than at the first pixel of the tiles, which is not exported
+        origin = tuple(min(place[1][axis] for *_, place in entries) for axis in (0, 1))
+        entries = [entry[:-1] + ((mosaic_path, (entry[-1][1][0] - origin[0], entry[-1][1][1] - origin[1])),) for entry in entries]
+
+    for prefix, annot_path, image_path, shape, window, output_path, place in entries:
+        # The key changes with the annotations, the class map and priorities, the crop window or the mosaic
+        settings = json.dumps([sorted(CLASS_LABELS.items()), sorted(priority.items()), shape, str(window), place])
+        with open(annot_path, 'rb') as f:
+            key = hashlib.sha1(settings.encode() + f.read()).hexdigest()
+        tiles.append((prefix, key, annot_path, image_path, shape, window, output_path, place))
+
+    if mosaic_path is not None and tiles:
+        extent = config.get('mosaic', {}).get('shape') or np.max([(row + window[0].stop - window[0].start, col + window[1].stop - window[1].start)
+                                                                   for _, _, _, _, _, window, _, (_, (row, col)) in tiles], axis=0)
+        mosaic, created = open_mosaic(mosaic_path, extent)
+        del mosaic  # The workers open it themselves
+        force = force or created
+
+    jobs = []
+    for tile in tiles:
+        prefix, key, output_path = tile[0], tile[1], tile[6]
+        if not force and manifest.get(prefix) == key and os.path.exists(output_path):
+            skipped += 1
+            continue
+        jobs.append(tile)
+
+    exported, n_points, n_bytes = 0, 0, 0
+    if jobs:
+        # The tiles are independent, rasterize them in parallel processes
+        from concurrent.futures import ProcessPoolExecutor  # Only the export needs the process machinery
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(_export_tile, annot_path, image_path, shape, window, output_path, place, priority): (prefix, key)
+                       for prefix, key, annot_path, image_path, shape, window, output_path, place in jobs}
+            for future in as_completed(futures):
+                prefix, key = futures[future]
+                try:
+                    tile_points, tile_bytes = future.result()
+                except Exception as error:
+                    failed.append((prefix, str(error)))
+                    continue
+                manifest[prefix] = key
+                exported += 1
+                n_points += tile_points
+                n_bytes += tile_bytes
+        write_atomic(manifest_path, lambda f: f.write(json.dumps(manifest, indent=1).encode()))
+
+    elapsed = time.perf_counter() - start
+    for prefix, message in failed:
+        print('Failed', prefix + ':', message)
+    print(f'{exported} tiles exported, {skipped} up to date, {len(failed)} failed in {elapsed:.2f} s')
+    if exported:
+        print(f'{exported / elapsed:.1f} tiles/s, {n_points / elapsed:.0f} points/s, {n_bytes / elapsed / 1e6:.1f} MB/s written')
+    return exported, skipped, failed
+
+def image_modality(path):
+    # The modality of an image of a tile from its name (prefix_sonar.npy...), None for other names
+    modality = os.path.splitext(os.path.basename(path))[0].rsplit('_', 1)[-1].lower()
+    return modality if modality in DatasetIndex.MODALITIES else None
+
+def compute_dataset_statistics(image_folder, workers=None, force=False):
+    # Percentiles of every modality over all the tiles of a folder, written to its DATASET_STATISTICS file.
+    # Every image is streamed through a QuantileSketch in a worker process and the sketches are merged here.
+    # A modality whose files did not change since the last run is kept as is
+    start = time.perf_counter()
+    statistics_path = os.path.join(image_folder, DATASET_STATISTICS)
+    statistics = {}
+    if os.path.exists(statistics_path):
+        with open(statistics_path, 'r') as f:
+            statistics = json.load(f)
+    dataset = DatasetIndex(image_folder)
+    jobs = {}
+    for index, modality in enumerate(DatasetIndex.MODALITIES):
+        paths = sorted(dataset.triplet(prefix)[index] for prefix in dataset.prefixes)
+        files = [[os.path.basename(path), os.path.getsize(path), os.stat(path).st_mtime_ns] for path in paths]
+        if force or statistics.get(modality, {}).get('files') != files:
+            jobs[modality] = (paths, files)
+
+    if jobs:
+        # The files are independent, sketch them in parallel processes
+        from concurrent.futures import ProcessPoolExecutor  # Only the precomputation needs the process machinery
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(_sketch_image, path): modality for modality, (paths, _) in jobs.items() for path in paths}
+            sketches = {modality: QuantileSketch() for modality in jobs}
+            for future in as_completed(futures):
+                sketches[futures[future]].merge(future.result())
+        for modality, sketch in sketches.items():
+            statistics[modality] = {
+                'files': jobs[modality][1],
+                'count': sketch.count,
+                'percentiles': sketch.quantiles(np.linspace(0, 1, 101)).tolist(),
+            }
+        write_atomic(statistics_path, lambda f: f.write(json.dumps(statistics).encode()))
+
+    for modality in DatasetIndex.MODALITIES:
+        if modality in statistics:
+            percentiles = statistics[modality]['percentiles']
+            print(f'{modality}: {statistics[modality]["count"]} values, min {percentiles[0]:.6g}, median {percentiles[50]:.6g}, max {percentiles[100]:.6g}')
+    print(f'{len(jobs)} modalities updated from {sum(len(paths) for paths, _ in jobs.values())} files in {time.perf_counter() - start:.2f} s')
+    return statistics
+
+def _sketch_image(path):
+    # Runs in the worker processes: the image is read by blocks of rows, never whole
+    data = load_array(path) if path.lower().endswith('.npy') else TiffImage(path)
+    sketch = QuantileSketch()
+    if len(data.shape) == 2:
+        block_rows = max(ImagePyramid.BLOCK_PIXELS // max(data.shape[1], 1), 1)
+        for row in range(0, data.shape[0], block_rows):
+            sketch.add(data[row:row + block_rows])
+    return sketch
+
+_dataset_statistics = {}  # Statistics of the folders already read, keyed by (path, modification time)
+
+def dataset_statistics(folder):
+    # Global percentiles of each modality of a folder, written by compute_dataset_statistics, empty without them
+    path = os.path.join(os.path.abspath(folder), DATASET_STATISTICS)
+    if not os.path.exists(path):
+        return {}
+    key = (path, os.stat(path).st_mtime_ns)
+    statistics = _dataset_statistics.get(key)
+    if statistics is None:
+        with open(path, 'r') as f:
+            statistics = {modality: np.array(values['percentiles'], dtype=np.float32) for modality, values in json.load(f).items()}
+        _dataset_statistics[key] = statistics
+    return statistics
+
+def _export_tile(annot_path, image_path, shape, window, output_path, place=None, class_priority=CLASS_PRIORITY):
+    # Runs in the export worker processes, the tiles write disjoint windows of the mosaic
+    segments = load_annotations(annot_path)
+    labels = export_labels(segments, shape, window, output_path, class_priority)
+    if place is not None:
+        mosaic_path, (row, col) = place
+        mosaic = np.load(mosaic_path, mmap_mode='r+')
+        mosaic[row:row + labels.shape[0], col:col + labels.shape[1]] = labels
+        mosaic.flush()
+    return sum(len(points) for _, _, points in segments), os.path.getsize(output_path)
+
+def tile_offset(prefix, mosaic_config):
+    # (row, column) of the first pixel of a tile in the survey array, from the "mosaic" setting of the dataset,
+    # None when the tile has no offset
+    offsets = mosaic_config.get('offsets', {})
+    if prefix in offsets:
+        return tuple(offsets[prefix])
+    match = re.search(mosaic_config['pattern'], prefix) if 'pattern' in mosaic_config else None
+    if match is None:
+        return None
+    step_rows, step_cols = mosaic_config.get('step', (1, 1))
+    return int(match.group('row')) * step_rows, int(match.group('col')) * step_cols
+
+def open_mosaic(path, shape):
+    # The survey label array as a memory map, created filled with 0 (not annotated) when it does not exist.
+    # Returns it with True when it was created
+    if os.path.exists(path):
+        mosaic = np.load(path, mmap_mode='r+')
+        if mosaic.shape[0] < shape[0] or mosaic.shape[1] < shape[1]:
+            raise ValueError(f"The mosaic {path} has the shape {mosaic.shape}, the tiles need {tuple(shape)}")
+        return mosaic, False
+    return np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=tuple(int(size) for size in shape)), True
+
+def image_shape(path):
+    # (height, width) of an image file, read from its header
+    if path.lower().endswith('.npy'):
+        return load_array(path).shape[:2]
+    try:
+        return TiffImage(path).shape[:2]
+    except ImportError:
+        size = QImageReader(path).size()
+        return (size.height(), size.width())
+
+class AnnotationJournal:
+    # Append-only log of the changes made to the annotations of a tile since they were saved, kept next to
+    # the output files as JSON lines. It starts with a header identifying the annotation file the changes
+    # apply to and the ids of its segments. Every save writes a mark, and once that save is on disk the
+    # records up to the mark are dropped, so both grow with the edits and not with the annotations
+    def __init__(self, path, header):
+        self.path = path
+        self.header = header
+        self._file = None
+        self._dirty = False
+        self._lock = threading.Lock()  # The saves cut the journal from their worker thread
+
+    def append(self, record):
+        line = json.dumps(record, default=lambda value: value.tolist()) + '\n'
+        with self._lock:
+            if self._file is None:
+                new = not os.path.exists(self.path)
+                self._file = open(self.path, 'a', encoding='utf-8')
+                if new:
+                    self._file.write(json.dumps(self.header) + '\n')
+            self._file.write(line)
+            self._dirty = True
+
+    def sync(self):
+        # The records written so far reach the disk, called periodically rather than for every record
+        with self._lock:
+            if self._dirty:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._dirty = False
+
+    def mark(self, ids):
+        # Mark the state being saved, with the ids of its segments
+        mark = time.time_ns()
+        self.append({'op': 'save', 'mark': mark, 'ids': list(ids)})
+        return mark
+
+    @traced('AnnotationJournal.cut')
+    def cut(self, mark, annot_path):
+        # The save of the mark is on disk: keep only the records after it, behind a header for the saved file
+        with self._lock:
+            self._close()
+            records = read_journal(self.path)
+            positions = [i for i, record in enumerate(records) if record['op'] == 'save' and record['mark'] == mark]
+            if not positions:
+                return
+            self.header = journal_header(annot_path, records[positions[0]]['ids'])
+            self._rewrite(records[positions[0] + 1:])
+
+    def rewrite(self, records):
+        # Replace the journal by the header and the records
+        with self._lock:
+            self._close()
+            self._rewrite(records)
+
+    def _rewrite(self, records):
+        if records:
+            lines = [json.dumps(record, default=lambda value: value.tolist()) + '\n' for record in [self.header] + records]
+            write_atomic(self.path, lambda f: f.write(''.join(lines).encode()))
+        elif os.path.exists(self.path):
+            # Nothing left to recover
+            os.remove(self.path)
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+            self._dirty = False
+
+def journal_header(annot_path, ids):
+    # Identify the annotation file a journal applies to, by its name, size and modification time
+    header = {'op': 'base', 'file': None, 'ids': list(ids)}
+    if annot_path is not None and os.path.exists(annot_path):
+        stat = os.stat(annot_path)
+        header.update(file=os.path.basename(annot_path), size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+    return header
+
+def read_journal(path):
+    # Records of a journal, up to the first incomplete line left by a crash
+    records = []
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break
+    return records
+
+def recover_journal(path, annot_path, count):
+    # Ids of the segments of the annotation file and records still to apply on them, or None if the journal
+    # does not apply to the file. A header describing another file means that a save ended before the
+    # journal was cut: that file is the save of the first mark
+    records = read_journal(path)
+    if not records or records[0]['op'] != 'base':
+        return None
+    header = journal_header(annot_path, [])
+    if all(records[0].get(key) == header.get(key) for key in ('file', 'size', 'mtime_ns')):
+        ids, records = records[0]['ids'], records[1:]
     else:
-        border_mask[start_y:end_y, start_x] = 0  # Left border
-        border_mask[start_y:end_y, end_x] = 0  # Right border
-        border_mask[start_y, start_x:end_x] = 0  # Top border
-        border_mask[end_y, start_x:end_x] = 0  # Bottom border
-
-    # Multiply the image with the border mask to apply the border
-    bordered_image = image * border_mask
+        marks = [i for i, record in enumerate(records) if record['op'] == 'save']
+        if not marks:
+            return None
+        ids, records = records[marks[0]]['ids'], records[marks[0] + 1:]
+    if len(ids) != count:
+        return None
+    return ids, [record for record in records if record['op'] != 'save']
+
+def find_annotation_file(output_folder, file_prefix):
+    # Most recently written annotation file of an image, None if it was never annotated
+    paths = [os.path.join(output_folder, file_prefix + '_annot' + extension) for extension in ('.npz', '.json')]
+    paths = [path for path in paths if os.path.exists(path)]
+    return max(paths, key=os.path.getmtime) if paths else None
+
+def load_annotations(path):
+    # Read a list of (color, thickness, points) segments from a .json or .npz annotation file
+    if path.lower().endswith('.npz'):
+        if os.name == 'nt':
+            # Windows cannot replace a file that is still mapped, which the next save of this file would do
+            with np.load(path) as archive:
+                arrays = dict(archive)
+        else:
+            arrays = _load_npz_mapped(path)
+        palette = [str(color) for color in arrays['palette']]
+        points = arrays['points']
+        # The points of every segment are views of the memory-mapped point array
+        return [
+            (palette[color], int(thickness) if thickness.is_integer() else thickness, points[offset:offset + length])
+            for color, thickness, offset, length in zip(arrays['colors'].tolist(), arrays['thickness'].tolist(), arrays['offsets'].tolist(), arrays['lengths'].tolist())
+        ]
+
+    with open(path, 'r') as f:
+        segments_data = json.load(f)
+    return [
+        (
+            data['color'], 
+            data['thickness'], 
+            [(float(x[0]), float(x[1])) for x in data['points']]  # Convert list back to tuple
+        ) 
+        for data in segments_data
+    ]
+
+def save_annotations(path, segments):
+    # Write the segments to a .json or .npz annotation file, atomically
+    if path.lower().endswith('.npz'):
+        write_atomic(path, lambda f: _write_npz(f, segments))
+    else:
+        segments_data = [{
+            'color': color,
+            'thickness': thickness,
+            'points': np.asarray(points, dtype=np.float64).tolist()
+        } for color, thickness, points in segments]
+        write_atomic(path, lambda f: f.write(json.dumps(segments_data).encode()))
+
+def convert_annotations(source, destination):
+    # Convert an annotation file between the .json and .npz formats
+    save_annotations(destination, load_annotations(source))
+
+def _write_npz(f, segments):
+    # A flat float64 array of all the points, with offset, length, class, color and thickness columns per segment, so
+    # the coordinates are those of the .json files. The archive is not compressed so that the arrays can be
+    # memory-mapped when loading
+    point_arrays = [np.asarray(points, dtype=np.float64).reshape(-1, 2) for _, _, points in segments]
+    lengths = np.array([len(points) for points in point_arrays], dtype=np.int64)
+    palette = sorted(set(color for color, _, _ in segments))
+    color_index = {color: index for index, color in enumerate(palette)}
+    np.savez(
+        f,
+        points=np.concatenate(point_arrays) if point_arrays else np.zeros((0, 2), dtype=np.float64),
+        offsets=np.cumsum(lengths) - lengths,
+        lengths=lengths,
+        class_ids=np.array([CLASS_LABELS.get(color.lower(), 0) for color, _, _ in segments], dtype=np.uint8),
+        colors=np.array([color_index[color] for color, _, _ in segments], dtype=np.uint16),
+        palette=np.array(palette, dtype=str),
+        thickness=np.array([thickness for _, thickness, _ in segments], dtype=np.float64),
+    )
+
+def _load_npz_mapped(path):
+    # Memory-map the arrays of an uncompressed .npz instead of reading them
+    arrays = {}
+    with zipfile.ZipFile(path) as archive, open(path, 'rb') as f:
+        for info in archive.infolist():
+            name = info.filename[:-len('.npy')]
+            if info.compress_type != zipfile.ZIP_STORED:
+                arrays[name] = np.load(archive.open(info))
+                continue
+            # The data starts after the local file header: 30 bytes, then the file name and the extra field
+            f.seek(info.header_offset + 26)
+            name_length, extra_length = np.frombuffer(f.read(4), dtype='<u2')
+            f.seek(info.header_offset + 30 + int(name_length) + int(extra_length))
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            if dtype.hasobject or 0 in shape:
+                # Nothing to map
+                arrays[name] = np.load(archive.open(info))
+            else:
+                arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=f.tell(), shape=shape, order='F' if fortran_order else 'C')
+    return arrays
+
+def write_atomic(path, write):
+    # Write to a temporary file next to path and rename it, so path is never left half-written
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix='.' + name + '.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        # Keep the permissions of the file being replaced, the temporary file is only readable by its owner
+        os.chmod(temp_path, os.stat(path).st_mode & 0o777 if os.path.exists(path) else 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def drawing_area_window(shape, area=None):
+    # Rows and columns of the drawing area, a square in the middle of the image or an explicit window.
+    # area is the "drawing_area" setting of the dataset, see DATASET_CONFIG
+    area = area or {}
+    if 'rows' in area:
+        return slice(*area['rows']), slice(*area['cols'])
+    if 'fraction' in area or 'size' in area:
+        size = round(area['fraction'] * shape[1]) if 'fraction' in area else area['size']
+        start_y, start_x = (shape[0] - size) // 2, (shape[1] - size) // 2
+        return slice(start_y, start_y + size), slice(start_x, start_x + size)
+    # By default the square of 100 pixels framed by the original tool, with its bottom and right border lines
+    start_y, start_x = (shape[0] - 100) // 2, (shape[1] - 100) // 2
+    return slice(start_y, start_y + 101), slice(start_x, start_x + 101)
 
-    return bordered_image
-    
 def main():
-    global main_window
-    app = QApplication(sys.argv)
+    global main_window, ANNOTATION_FORMAT, SIMPLIFY_TOLERANCE, SIMPLIFY_ON_LOAD
+    parser = argparse.ArgumentParser(description='Graphical interface for image annotation')
+    parser.add_argument('--annotation-format', choices=['npz', 'json'], default=ANNOTATION_FORMAT, help='format of the saved annotation files')
+    parser.add_argument('--convert', nargs=2, metavar=('SOURCE', 'DESTINATION'), help='convert an annotation file between the .json and .npz formats and exit')
+    parser.add_argument('--export', metavar='OUTPUT_FOLDER', help='re-export the label matrix of every annotation in OUTPUT_FOLDER without opening a window, and exit')
+    parser.add_argument('--images', metavar='IMAGE_FOLDER', help='folder of the images, for --export')
+    parser.add_argument('--workers', type=int, default=None, help='number of export or statistics processes (default: one per CPU)')
+    parser.add_argument('--force', action='store_true', help='with --export or --statistics, also redo the tiles or modalities that are up to date')
+    parser.add_argument('--mosaic', metavar='MOSAIC.npy', help='with --export, also write the labels of every tile at its place in this survey-wide label array, created when missing (see DATASET_CONFIG)')
+    parser.add_argument('--statistics', metavar='IMAGE_FOLDER', help='compute the percentiles of every modality over the images of IMAGE_FOLDER for the global normalization, and exit')
+    parser.add_argument('--simplify-tolerance', type=float, default=SIMPLIFY_TOLERANCE, metavar='PIXELS', help='simplify the strokes to this distance in image pixels, 0 keeps every mouse event (default: %(default)s)')
+    parser.add_argument('--simplify-on-load', action='store_true', help='also simplify the annotations loaded from disk')
+    parser.add_argument('--startup-profile', action='store_true', help='print the duration of each startup phase once the first image is painted')
+    # The remaining arguments are left to Qt
+    args, qt_args = parser.parse_known_args()
+
+    if args.convert:
+        convert_annotations(*args.convert)
+        return
+    if args.statistics:
+        compute_dataset_statistics(args.statistics, args.workers, args.force)
+        return
+    if args.export:
+        if not args.images:
+            parser.error('--export needs the image folder (--images)')
+        export_folder(args.export, args.images, args.workers, args.force, args.mosaic)
+        return
+    ANNOTATION_FORMAT = args.annotation_format
+    SIMPLIFY_TOLERANCE = args.simplify_tolerance
+    SIMPLIFY_ON_LOAD = args.simplify_on_load
+    startup_profile.enabled = args.startup_profile
+    startup_profile.mark('imports')
+    preload_modules()
+
+    app = QApplication(sys.argv[:1] + qt_args)
+    startup_profile.mark('QApplication')
 
     folder_selection_window = FolderSelectionWindow()
     folder_selection_window.show()
+    # Marked once the event loop has processed the first paint of the window
+    QTimer.singleShot(0, lambda: startup_profile.mark('first window shown'))
 
     sys.exit(app.exec_())
 
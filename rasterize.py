@@ -0,0 +1,133 @@
+# Rasterization of annotation segments into label matrices. Only numpy is needed, so scripts can use it without Qt:
+#   from rasterize import rasterize_segments
+#   labels = rasterize_segments(segments, (height, width), {'#0b9224': 1})
+import numpy as np
+
+# Segments of this thickness are regions: their points are a closed outline and the inside is labeled (even-odd rule)
+FILL_THICKNESS = 0
+RASTER_BATCH = 1 << 22  # Number of samples drawn at once by rasterize_segments
+
+def rasterize_segments(segments, shape, class_labels, class_priority=None, window=None):
+    # Draw the segments (colors, thicknesses and relative coordinates) into a label matrix of the given shape, at the
+    # resolution of the data. class_labels gives the label of each color, the segments of other colors are not drawn.
+    # The strokes are drawn with their thickness in pixels, and later segments are drawn over earlier ones. The regions
+    # (FILL_THICKNESS) are filled below the strokes, by class priority (color -> number, 0 by default) and then in order.
+    # With a window (rows, columns), only that part of the matrix is drawn and returned.
+    # The segments are drawn in vectorized batches
+    height, width = shape[:2]
+    rows, cols = window if window is not None else (slice(0, height), slice(0, width))
+    rows, cols = slice(*rows.indices(height)[:2]), slice(*cols.indices(width)[:2])
+    window_height, window_width = max(rows.stop - rows.start, 0), max(cols.stop - cols.start, 0)
+
+    # Every pixel keeps the largest key drawn on it: the regions get the first keys, by priority and order, and the
+    # strokes the next ones in order
+    regions = [order for order, (_, thickness, points) in enumerate(segments) if thickness == FILL_THICKNESS and len(points) >= 3]
+    class_priority = class_priority or {}
+    regions.sort(key=lambda order: class_priority.get(segments[order][0].lower(), 0))
+    keys = np.arange(len(segments), dtype=np.int32) + len(regions)
+    keys[regions] = np.arange(len(regions), dtype=np.int32)
+    key_labels = np.zeros(len(regions) + len(segments) + 1, dtype=np.uint8)  # Label of each key, the last one for none
+
+    # Pairs of consecutive points in pixel coordinates (pixel centers at integers), grouped by thickness
+    pairs = {}
+    polygons = []
+    for order, (color, thickness, points) in enumerate(segments):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        key_labels[keys[order]] = class_labels.get(color.lower(), 0)
+        if len(points) == 0 or key_labels[keys[order]] == 0:
+            continue
+        points = points * (width, height) - 0.5
+        if thickness == FILL_THICKNESS:
+            if len(points) >= 3:
+                polygons.append((keys[order], points))
+            continue
+        if len(points) == 1:
+            points = np.repeat(points, 2, axis=0)  # A single click draws a dot
+        group = pairs.setdefault(thickness, ([], [], []))
+        group[0].append(points[:-1])
+        group[1].append(points[1:])
+        group[2].append(np.full(len(points) - 1, keys[order], dtype=np.int32))
+
+    # Key of the last segment drawn on every pixel of the window
+    last_segment = np.full(window_height * window_width, -1, dtype=np.int32)
+    if polygons and last_segment.size:
+        polygon_keys, polygon_points = zip(*polygons)
+        _fill_regions(polygon_points, polygon_keys, last_segment, rows, cols)
+    for thickness, (starts, ends, pair_orders) in pairs.items():
+        starts, ends, pair_orders = np.concatenate(starts), np.concatenate(ends), np.concatenate(pair_orders)
+        offsets = _disk_offsets(thickness)
+
+        # One sample per pixel along the longest axis of every pair (DDA), in batches of about RASTER_BATCH samples
+        steps = np.ceil(np.abs(ends - starts).max(axis=1)).astype(np.int64) + 1
+        cumulative = np.cumsum(steps * len(offsets))
+        bounds = np.searchsorted(cumulative, np.arange(RASTER_BATCH, cumulative[-1], RASTER_BATCH), side='right')
+        bounds = np.unique(np.concatenate([[0], bounds, [len(steps)]]))
+        for batch_start, batch_end in zip(bounds[:-1], bounds[1:]):
+            batch = slice(batch_start, batch_end)
+            batch_steps = steps[batch]
+            pair_index = np.repeat(np.arange(len(batch_steps)), batch_steps)
+            position = np.arange(pair_index.size) - np.repeat(np.cumsum(batch_steps) - batch_steps, batch_steps)
+            t = position / np.maximum(batch_steps - 1, 1)[pair_index]
+            batch_starts = starts[batch]
+            samples = batch_starts[pair_index] + (ends[batch] - batch_starts)[pair_index] * t[:, None]
+            samples = np.rint(samples).astype(np.int64) - (cols.start, rows.start)
+
+            # Stamp a disk of the stroke width on every sample
+            samples = (samples[:, None, :] + offsets[None, :, :]).reshape(-1, 2)
+            pair_index = np.repeat(pair_index, len(offsets))
+
+            # Keep the samples inside the window
+            valid = (0 <= samples[:, 0]) & (samples[:, 0] < window_width) & (0 <= samples[:, 1]) & (samples[:, 1] < window_height)
+            pixels = samples[valid, 1] * window_width + samples[valid, 0]
+            np.maximum.at(last_segment, pixels, pair_orders[batch][pair_index[valid]])
+
+    return key_labels[last_segment].reshape(window_height, window_width)
+
+def _fill_regions(polygons, keys, last_segment, rows, cols):
+    # Even-odd scanline fill of closed polygons (pixel coordinates) into last_segment, the flat matrix of the window
+    # (rows, columns), keeping the largest key on every pixel. A pixel is inside when its center is, crossings are
+    # found for all the edges and rows at once
+    edges = [(polygon, np.roll(polygon, -1, axis=0), np.full(len(polygon), key, dtype=np.int32))
+             for polygon, key in zip(polygons, keys)]
+    starts, ends, edge_keys = (np.concatenate(part) for part in zip(*edges))
+    # Rows whose center is in [top, bottom) of each edge, horizontal edges cross none
+    top, bottom = np.minimum(starts[:, 1], ends[:, 1]), np.maximum(starts[:, 1], ends[:, 1])
+    first_row = np.clip(np.ceil(top), rows.start, rows.stop).astype(np.int64)
+    rows_crossed = np.maximum(np.clip(np.ceil(bottom), rows.start, rows.stop).astype(np.int64) - first_row, 0)
+    crossing_edge = np.repeat(np.arange(len(starts)), rows_crossed)
+    if crossing_edge.size == 0:
+        return
+    row = first_row[crossing_edge] + np.arange(crossing_edge.size) - np.repeat(np.cumsum(rows_crossed) - rows_crossed, rows_crossed)
+    x0, y0 = starts[crossing_edge, 0], starts[crossing_edge, 1]
+    x1, y1 = ends[crossing_edge, 0], ends[crossing_edge, 1]
+    x = x0 + (row - y0) * (x1 - x0) / (y1 - y0)
+    key = edge_keys[crossing_edge]
+
+    # Every row of a closed polygon has an even number of crossings, consecutive ones bound the spans inside
+    order = np.lexsort((x, row, key))
+    x, row, key = x[order], row[order], key[order]
+    span_start = np.clip(np.ceil(x[0::2]), cols.start, cols.stop).astype(np.int64)
+    span_length = np.clip(np.ceil(x[1::2]), cols.start, cols.stop).astype(np.int64) - span_start
+    inside = span_length > 0
+    span_start = (row[0::2][inside] - rows.start) * (cols.stop - cols.start) + span_start[inside] - cols.start
+    span_length, span_key = span_length[inside], key[0::2][inside]
+
+    # Pixels of the spans, in batches of about RASTER_BATCH
+    cumulative = np.cumsum(span_length)
+    if cumulative.size == 0:
+        return
+    bounds = np.searchsorted(cumulative, np.arange(RASTER_BATCH, cumulative[-1], RASTER_BATCH), side='right')
+    bounds = np.unique(np.concatenate([[0], bounds, [len(span_length)]]))
+    for batch_start, batch_end in zip(bounds[:-1], bounds[1:]):
+        lengths = span_length[batch_start:batch_end]
+        span_index = np.repeat(np.arange(len(lengths)), lengths)
+        pixels = span_start[batch_start:batch_end][span_index] + np.arange(span_index.size) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        np.maximum.at(last_segment, pixels, span_key[batch_start:batch_end][span_index])
+
+def _disk_offsets(thickness):
+    # (x, y) offsets of the pixels covered by a round pen of the given width
+    radius = max(float(thickness), 1) / 2
+    r = int(np.floor(radius))
+    dy, dx = np.mgrid[-r:r + 1, -r:r + 1]
+    inside = dx ** 2 + dy ** 2 <= radius ** 2
+    return np.stack([dx[inside], dy[inside]], axis=1)
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The modules are at the root of the repository, main imports PyQt5 which needs no display with this platform
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
@@ -0,0 +1,184 @@
+import copy
+import math
+
+import numpy as np
+import pytest
+
+from main import (CLASS_LABELS, CLASS_PRIORITY, AnnotationJournal, AnnotationStore, CoverageCounter, SegmentIndex,
+                  journal_header, load_annotations, recover_journal, save_annotations, simplify_points)
+from rasterize import FILL_THICKNESS, rasterize_segments
+
+COLORS = ['#0b9224', '#0c03d2', '#d55e09', '#fef22f']
+SHAPE = (60, 80)
+WINDOW = (slice(10, 50), slice(15, 70))
+
+def random_points(rng, count):
+    return [tuple(point) for point in rng.random((count, 2)).tolist()]
+
+def random_segments(rng, count):
+    return [(COLORS[i % len(COLORS)], FILL_THICKNESS if i % 4 == 3 else int(rng.integers(1, 6)), random_points(rng, int(rng.integers(1, 6))))
+            for i in range(count)]
+
+def random_edit(store, rng, actions=6):
+    # One action of the user: a stroke or a region drawn point by point, an erase, an undo or a redo
+    action = rng.integers(actions)
+    if action < 2:
+        store.begin_action()
+        index = store.add_segment(COLORS[int(rng.integers(len(COLORS)))], FILL_THICKNESS if action else int(rng.integers(1, 6)), random_points(rng, 1))
+        for _ in range(int(rng.integers(0, 5))):
+            store.extend_segment(index, random_points(rng, 1))
+        if rng.random() < 0.3:
+            # The simplification of the stroke
+            store.replace_points(index, store.segments[index][2][::2] or store.segments[index][2])
+        store.end_action()
+    elif action == 2 and store.ids:
+        store.remove_segments(rng.choice(store.ids, size=min(len(store.ids), 2), replace=False).tolist())
+    elif action == 3:
+        store.undo()
+    elif action == 4:
+        store.redo()
+
+def snapshot(store):
+    return [(color, thickness, [tuple(point) for point in points]) for color, thickness, points in store.segments], list(store.ids)
+
+@pytest.mark.parametrize('seed', range(3))
+def test_coverage_matches_a_full_rasterization_after_every_edit(seed):
+    rng = np.random.default_rng(seed)
+    store = AnnotationStore()
+    store.coverage = CoverageCounter(SHAPE, WINDOW)
+    store.set_segments(random_segments(rng, 12))
+    for _ in range(60):
+        random_edit(store, rng)
+        expected = rasterize_segments(store.segments, SHAPE, CLASS_LABELS, CLASS_PRIORITY, window=WINDOW)
+        np.testing.assert_array_equal(store.coverage.labels, expected)
+        np.testing.assert_array_equal(store.coverage.counts, np.bincount(expected.ravel(), minlength=len(CLASS_LABELS) + 1))
+
+def test_undo_and_redo_walk_back_and_forth_through_the_actions():
+    rng = np.random.default_rng(3)
+    store = AnnotationStore()
+    store.set_segments(random_segments(rng, 5))
+    # The state after each action of the history, an undo or redo moves along it and any other edit ends it
+    states = [copy.deepcopy(snapshot(store))]
+    for _ in range(30):
+        if rng.random() < 0.3:
+            store.undo() if rng.random() < 0.6 else store.redo()
+        else:
+            version = store.version
+            random_edit(store, rng, 3)
+            if store.version != version:
+                states = states[:len(store._undo)] + [copy.deepcopy(snapshot(store))]
+        assert snapshot(store) == states[len(store._undo)]
+    while store._undo:
+        store.undo()
+        assert snapshot(store) == states[len(store._undo)]
+    while store._redo:
+        store.redo()
+        assert snapshot(store) == states[len(store._undo)]
+
+def test_journal_replay_gives_back_the_segments(tmp_path):
+    rng = np.random.default_rng(4)
+    initial = random_segments(rng, 6)
+    store = AnnotationStore()
+    store.set_segments(copy.deepcopy(initial))
+    path = str(tmp_path / 'tile_annot.journal')
+    store.journal = AnnotationJournal(path, journal_header(None, store.ids))
+    for _ in range(40):
+        random_edit(store, rng)
+    store.journal.close()
+
+    ids, records = recover_journal(path, None, len(initial))
+    recovered = AnnotationStore()
+    recovered.set_segments(copy.deepcopy(initial), ids)
+    recovered.replay(records)
+    assert snapshot(recovered) == snapshot(store)
+
+def brute_force_hits(segments, x_rel, y_rel, radius, shape):
+    height, width = shape
+    hits = set()
+    for segment_id, (_, thickness, points) in enumerate(segments):
+        pixels = np.asarray(points, dtype=np.float64).reshape(-1, 2) * (width, height)
+        pairs = zip(pixels[:-1], pixels[1:]) if len(pixels) > 1 else [(pixels[0], pixels[0])]
+        point = np.array([x_rel * width, y_rel * height])
+        for start, end in pairs:
+            piece = end - start
+            t = min(max((point - start) @ piece / (piece @ piece), 0), 1) if piece @ piece > 0 else 0
+            if math.dist(point, start + t * piece) <= radius + thickness / 2:
+                hits.add(segment_id)
+    return hits
+
+def test_segment_index_hits_match_the_distance_to_every_piece():
+    rng = np.random.default_rng(5)
+    segments = [(COLORS[0], int(rng.integers(1, 8)), random_points(rng, int(rng.integers(1, 8)))) for _ in range(60)]
+    index = SegmentIndex()
+    index.rebuild(range(40), segments[:40])
+    # The pieces added or removed afterwards, and a segment extended
+    for segment_id in range(40, 60):
+        index.add(segment_id, segments[segment_id][1], segments[segment_id][2])
+    for segment_id in range(0, 60, 7):
+        index.remove(segment_id)
+    extended = list(segments[1][2]) + random_points(rng, 3)
+    index.add(1, segments[1][1], extended, len(segments[1][2]) - 1)
+    segments[1] = (segments[1][0], segments[1][1], extended)
+    remaining = {segment_id: segment for segment_id, segment in enumerate(segments) if segment_id % 7}
+    for x_rel, y_rel in rng.random((200, 2)).tolist():
+        expected = {segment_id for segment_id in brute_force_hits(segments, x_rel, y_rel, 4, (100, 100)) if segment_id in remaining}
+        assert index.hits(x_rel, y_rel, 4, (100, 100)) == expected
+
+def test_segment_index_finds_the_segments_crossing_a_rectangle():
+    rng = np.random.default_rng(6)
+    segments = random_segments(rng, 80)
+    index = SegmentIndex()
+    index.rebuild(range(80), segments)
+    boxes = [(0.2, 0.3, 0.25, 0.32), (0.6, 0.6, 0.6, 0.6)]
+    found = index.segments_in(boxes, (100, 100))
+    for segment_id, (_, thickness, points) in enumerate(segments):
+        points = np.asarray(points)
+        low, high = points.min(axis=0), points.max(axis=0)
+        for x_min, y_min, x_max, y_max in boxes:
+            inside = ((x_min <= points[:, 0]) & (points[:, 0] <= x_max) & (y_min <= points[:, 1]) & (points[:, 1] <= y_max)).any()
+            # The inside of a region crosses the rectangle without any of its points
+            around = thickness == FILL_THICKNESS and (low <= (x_min, y_min)).all() and ((x_max, y_max) <= high).all()
+            if inside or around:
+                assert segment_id in found
+
+def test_simplify_points_stays_within_the_tolerance():
+    rng = np.random.default_rng(7)
+    points = np.cumsum(rng.normal(0, 0.01, (200, 2)), axis=0) + 0.5
+    simplified = np.array(simplify_points(points, 1.0, (100, 100)))
+    assert len(simplified) < len(points)
+    assert (simplified[[0, -1]] == points[[0, -1]]).all()
+    # Every point is within the tolerance of the simplified line, in pixels
+    for point in points * 100:
+        pixels = simplified * 100
+        distances = []
+        for start, end in zip(pixels[:-1], pixels[1:]):
+            piece = end - start
+            t = min(max((point - start) @ piece / (piece @ piece), 0), 1) if piece @ piece > 0 else 0
+            distances.append(math.dist(point, start + t * piece))
+        assert min(distances) <= 1.0 + 1e-9
+    assert simplify_points([(0.1, 0.1), (0.2, 0.2), (0.3, 0.3)], 1.0, (100, 100)) == [(0.1, 0.1), (0.3, 0.3)]
+    assert len(simplify_points(points, 0, (100, 100))) == len(points)
+
+@pytest.mark.parametrize('segments', [
+    [],
+    [('#0b9224', 3, [(0.25, 0.75)])],
+    [('#0b9224', 3, [(0.1, 0.2), (0.123456789012345, 0.3)]), ('#0c03d2', FILL_THICKNESS, [(0.5, 0.5), (0.6, 0.5), (0.6, 0.6)]), ('#0b9224', 2.5, [(1 / 3, 2 / 3)])],
+], ids=['empty', 'single point', 'segments'])
+def test_npz_and_json_files_load_the_same_segments(tmp_path, segments):
+    for extension in ('npz', 'json'):
+        path = str(tmp_path / f'tile_annot.{extension}')
+        save_annotations(path, segments)
+        loaded = load_annotations(path)
+        assert [(color, thickness, [tuple(point) for point in np.asarray(points).reshape(-1, 2).tolist()]) for color, thickness, points in loaded] == segments
+        assert all(type(loaded_thickness) is type(thickness) for (_, loaded_thickness, _), (_, thickness, _) in zip(loaded, segments))
+
+def test_compressed_npz_files_are_read_without_mapping(tmp_path):
+    # A .npz compressed by another tool cannot be memory-mapped, its arrays are read instead
+    segments = [('#0b9224', 3, [(0.1, 0.2), (0.3, 0.4)]), ('#d55e09', 1, [(0.5, 0.6)])]
+    path = str(tmp_path / 'tile_annot.npz')
+    save_annotations(path, segments)
+    with np.load(path) as archive:
+        arrays = dict(archive)
+    np.savez_compressed(path, **arrays)
+    assert [(color, thickness, np.asarray(points).tolist()) for color, thickness, points in load_annotations(path)] == \
+        [(color, thickness, [list(point) for point in points]) for color, thickness, points in segments]
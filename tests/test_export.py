@@ -0,0 +1,90 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from main import CLASS_LABELS, DATASET_CONFIG, drawing_area_window, export_folder, save_annotations, tile_offset
+from rasterize import FILL_THICKNESS, rasterize_segments
+
+def test_default_drawing_area_is_the_historical_square():
+    assert drawing_area_window((300, 400)) == (slice(100, 201), slice(150, 251))
+
+@pytest.mark.parametrize('area, window', [
+    ({'size': 150}, (slice(75, 225), slice(125, 275))),
+    ({'size': 101}, (slice(99, 200), slice(149, 250))),
+    ({'fraction': 0.25}, (slice(100, 200), slice(150, 250))),
+    ({'rows': [10, 20], 'cols': [30, 45]}, (slice(10, 20), slice(30, 45))),
+])
+def test_drawing_area_setting(area, window):
+    assert drawing_area_window((300, 400), area) == window
+    rows, cols = window
+    assert np.zeros((300, 400))[rows, cols].shape == (rows.stop - rows.start, cols.stop - cols.start)
+
+def test_tile_offset_from_the_offsets_or_the_pattern():
+    config = {'offsets': {'survey_a': [5, 7]}, 'pattern': r'r(?P<row>\d+)_c(?P<col>\d+)', 'step': [40, 50]}
+    assert tile_offset('survey_a', config) == (5, 7)
+    assert tile_offset('survey_r2_c3', config) == (80, 150)
+    assert tile_offset('survey_b', config) is None
+    assert tile_offset('survey_r2_c3', {}) is None
+
+TILE = 40  # Size of the test tiles, with a drawing area of 10 pixels in their middle
+CONFIG = {'drawing_area': {'size': 10}, 'mosaic': {'pattern': r'r(?P<row>\d+)_c(?P<col>\d+)', 'step': [10, 10]}}
+
+def tile_segments(row, col):
+    # Different annotations on every tile, drawn over its drawing area (rows and columns 15 to 25)
+    return [('#0b9224', FILL_THICKNESS, [(0.4, 0.4), (0.55 + row * 0.02, 0.4), (0.5, 0.6 + col * 0.02)]),
+            ('#0c03d2', 2, [(0.35, 0.45 + col * 0.02), (0.65, 0.5 + row * 0.02)])]
+
+@pytest.fixture
+def dataset(tmp_path):
+    # A grid of 2 x 3 tiles with their images and annotations
+    images, output = tmp_path / 'images', tmp_path / 'output'
+    images.mkdir()
+    output.mkdir()
+    (images / DATASET_CONFIG).write_text(json.dumps(CONFIG))
+    for row in range(2):
+        for col in range(3):
+            prefix = f'survey_r{row}_c{col}'
+            for modality in ('sonar', 'bathy', 'tri'):
+                np.save(images / f'{prefix}_{modality}.npy', np.zeros((TILE, TILE), dtype=np.float32))
+            save_annotations(str(output / f'{prefix}_annot.json'), tile_segments(row, col))
+    return str(images), str(output)
+
+def expected_labels(row, col):
+    return rasterize_segments(tile_segments(row, col), (TILE, TILE), CLASS_LABELS, window=drawing_area_window((TILE, TILE), CONFIG['drawing_area']))
+
+def test_export_rerun_skips_the_tiles_up_to_date(dataset):
+    images, output = dataset
+    exported, skipped, failed = export_folder(output, images, workers=1)
+    assert (exported, skipped, failed) == (6, 0, [])
+    for row in range(2):
+        for col in range(3):
+            labels = np.load(os.path.join(output, f'survey_r{row}_c{col}_output.npy'))
+            assert labels.dtype == np.float64
+            np.testing.assert_array_equal(labels, expected_labels(row, col))
+    assert export_folder(output, images, workers=1) == (0, 6, [])
+    # Only the tile whose annotations changed is exported again
+    save_annotations(os.path.join(output, 'survey_r1_c2_annot.json'), tile_segments(1, 2)[:1])
+    assert export_folder(output, images, workers=1) == (1, 5, [])
+    assert export_folder(output, images, workers=1, force=True) == (6, 0, [])
+
+def test_export_reports_the_tiles_without_images(dataset):
+    images, output = dataset
+    save_annotations(os.path.join(output, 'other_annot.json'), [])
+    exported, skipped, failed = export_folder(output, images, workers=1)
+    assert (exported, skipped) == (6, 0)
+    assert [prefix for prefix, _ in failed] == ['other']
+
+def test_mosaic_starts_at_the_first_drawing_area(dataset, tmp_path):
+    images, output = dataset
+    mosaic_path = str(tmp_path / 'mosaic.npy')
+    assert export_folder(output, images, workers=1, mosaic_path=mosaic_path)[:2] == (6, 0)
+    mosaic = np.load(mosaic_path)
+    # The drawing areas of 10 pixels are placed every 10 pixels, without any band left out
+    assert mosaic.shape == (20, 30)
+    for row in range(2):
+        for col in range(3):
+            np.testing.assert_array_equal(mosaic[row * 10:row * 10 + 10, col * 10:col * 10 + 10], expected_labels(row, col))
+    # The mosaic is up to date as well
+    assert export_folder(output, images, workers=1, mosaic_path=mosaic_path)[:2] == (0, 6)
@@ -0,0 +1,121 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from main import AnnotationJournal, QuantileSketch, journal_header, read_journal, recover_journal, write_atomic
+
+def rank_error(sketch, values, fractions):
+    # Largest distance between the fractions and the ranks of the values returned for them
+    ranks = np.searchsorted(np.sort(values), sketch.quantiles(fractions), side='right') / values.size
+    return np.abs(ranks - fractions).max()
+
+def test_sketch_rank_error_and_memory():
+    values = np.random.default_rng(0).normal(size=200000).astype(np.float32)
+    sketch = QuantileSketch(k=256)
+    for part in np.array_split(values, 50):
+        sketch.add(part)
+    assert sketch.count == values.size
+    assert rank_error(sketch, values, np.linspace(0.01, 0.99, 99)) < 4 / sketch.k
+    assert sum(level.size for level in sketch.levels) <= 3 * sketch.k
+    # The extremes are exact
+    assert sketch.quantiles([0, 1]).tolist() == [values.min(), values.max()]
+
+def test_sketch_merge_is_a_sketch_of_all_the_values():
+    values = np.random.default_rng(1).exponential(size=100000).astype(np.float32)
+    first, second = QuantileSketch(k=256), QuantileSketch(k=256, seed=1)
+    first.add(values[:30000])
+    second.add(values[30000:])
+    first.merge(second)
+    assert (first.count, first.min, first.max) == (values.size, values.min(), values.max())
+    assert rank_error(first, values, np.linspace(0.01, 0.99, 99)) < 4 / first.k
+
+def test_sketch_ignores_non_finite_values():
+    sketch = QuantileSketch()
+    assert np.isnan(sketch.quantiles([0.5])).all()
+    sketch.add([np.nan, np.inf, -np.inf])
+    assert sketch.count == 0
+    sketch.add([1, np.nan, 3, 2])
+    assert sketch.count == 3 and sketch.quantiles([0, 0.5, 1]).tolist() == [1, 2, 3]
+
+@pytest.fixture
+def annot_path(tmp_path):
+    path = tmp_path / 'image1_annot.json'
+    path.write_text('[]')
+    return str(path)
+
+def add(segment_id):
+    return {'op': 'add', 'id': segment_id, 'color': '#0b9224', 'thickness': 5, 'points': [[0.1, 0.2], [0.3, 0.4]]}
+
+def test_journal_records_are_recovered(tmp_path, annot_path):
+    path = str(tmp_path / 'image1.journal')
+    journal = AnnotationJournal(path, journal_header(annot_path, [1, 2]))
+    journal.append(add(3))
+    journal.append({'op': 'remove', 'ids': [1]})
+    journal.close()
+    assert recover_journal(path, annot_path, 2) == ([1, 2], [add(3), {'op': 'remove', 'ids': [1]}])
+    # The journal of another number of segments or of no file does not apply
+    assert recover_journal(path, annot_path, 3) is None
+    assert recover_journal(str(tmp_path / 'missing.journal'), annot_path, 2) is None
+
+def test_journal_recovery_stops_at_an_incomplete_line(tmp_path, annot_path):
+    path = str(tmp_path / 'image1.journal')
+    journal = AnnotationJournal(path, journal_header(annot_path, []))
+    journal.append(add(1))
+    journal.close()
+    with open(path, 'a') as f:
+        f.write(json.dumps(add(2))[:20])
+    assert read_journal(path)[1:] == [add(1)]
+    assert recover_journal(path, annot_path, 0) == ([], [add(1)])
+
+def test_journal_cut_keeps_the_records_after_the_save(tmp_path, annot_path):
+    path = str(tmp_path / 'image1.journal')
+    journal = AnnotationJournal(path, journal_header(annot_path, []))
+    journal.append(add(1))
+    mark = journal.mark([1])
+    journal.append(add(2))
+    with open(annot_path, 'w') as f:
+        f.write('[{}]')
+    journal.cut(mark, annot_path)
+    journal.close()
+    assert read_journal(path)[0] == journal_header(annot_path, [1])
+    assert recover_journal(path, annot_path, 1) == ([1], [add(2)])
+    # Nothing left after the last save: the journal is removed
+    mark = journal.mark([1, 2])
+    journal.cut(mark, annot_path)
+    assert not os.path.exists(path)
+
+def test_journal_of_a_save_not_cut_applies_after_the_mark(tmp_path, annot_path):
+    # The save of the mark reached the disk but the journal still starts with the previous file
+    path = str(tmp_path / 'image1.journal')
+    journal = AnnotationJournal(path, journal_header(annot_path, []))
+    journal.append(add(1))
+    journal.mark([1])
+    journal.append(add(2))
+    journal.close()
+    with open(annot_path, 'w') as f:
+        f.write('[{}]')
+    assert recover_journal(path, annot_path, 1) == ([1], [add(2)])
+
+def test_write_atomic_replaces_the_file_and_keeps_its_permissions(tmp_path):
+    path = tmp_path / 'out.json'
+    path.write_text('old')
+    os.chmod(path, 0o640)
+    write_atomic(str(path), lambda f: f.write(b'new'))
+    assert path.read_text() == 'new'
+    assert os.stat(path).st_mode & 0o777 == 0o640
+    assert os.listdir(tmp_path) == ['out.json']
+
+def test_write_atomic_leaves_the_file_untouched_on_error(tmp_path):
+    path = tmp_path / 'out.json'
+    path.write_text('old')
+
+    def write(f):
+        f.write(b'half')
+        raise RuntimeError('interrupted')
+
+    with pytest.raises(RuntimeError):
+        write_atomic(str(path), write)
+    assert path.read_text() == 'old'
+    assert os.listdir(tmp_path) == ['out.json']
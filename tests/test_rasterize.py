@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+
+from rasterize import FILL_THICKNESS, _fill_regions, rasterize_segments
+
+GREEN, BLUE, RED = '#0b9224', '#0c03d2', '#d55e09'
+LABELS = {GREEN: 1, BLUE: 2, RED: 3}
+
+def center(column, row, size=10):
+    # Relative coordinates of the center of a pixel
+    return ((column + 0.5) / size, (row + 0.5) / size)
+
+def square(first, last, size=10):
+    # Outline of a region covering the pixels first to last on both axes
+    low, high = first / size, (last + 1) / size
+    return [(low, low), (high, low), (high, high), (low, high)]
+
+def test_stroke_covers_the_pixels_between_its_points():
+    labels = rasterize_segments([(GREEN, 1, [center(0, 4), center(9, 4)])], (10, 10), LABELS)
+    expected = np.zeros((10, 10), dtype=np.uint8)
+    expected[4] = 1
+    np.testing.assert_array_equal(labels, expected)
+
+def test_stroke_thickness_is_a_round_pen():
+    # A single point draws a dot: the 5 x 5 pixels around it but the corners
+    labels = rasterize_segments([(GREEN, 5, [center(5, 5)])], (10, 10), LABELS)
+    assert labels.sum() == 21
+    assert labels[3:8, 3:8].sum() == 21 and labels[[3, 3, 7, 7], [3, 7, 3, 7]].tolist() == [0, 0, 0, 0]
+
+def test_unknown_colors_and_empty_segments_are_not_drawn():
+    labels = rasterize_segments([('#123456', 1, [center(0, 0), center(9, 9)]), (GREEN, 1, [])], (10, 10), LABELS)
+    assert not labels.any()
+
+def test_later_strokes_are_drawn_over_earlier_ones():
+    segments = [(GREEN, 1, [center(5, 0), center(5, 9)]), (BLUE, 1, [center(0, 5), center(9, 5)])]
+    assert rasterize_segments(segments, (10, 10), LABELS)[5, 5] == 2
+    assert rasterize_segments(segments[::-1], (10, 10), LABELS)[5, 5] == 1
+
+def test_regions_are_filled_below_the_strokes():
+    segments = [(GREEN, 1, [center(0, 5), center(9, 5)]), (BLUE, FILL_THICKNESS, square(2, 7))]
+    labels = rasterize_segments(segments, (10, 10), LABELS)
+    assert labels[5].tolist() == [1] * 10
+    assert (labels[2:8, 2:8][labels[2:8, 2:8] != 1] == 2).all()
+    assert (labels[labels == 2].size, labels[0, 0]) == (30, 0)
+
+def test_region_priority_decides_the_overlaps():
+    segments = [(GREEN, FILL_THICKNESS, square(0, 5)), (BLUE, FILL_THICKNESS, square(4, 9))]
+    assert rasterize_segments(segments, (10, 10), LABELS)[5, 5] == 2
+    assert rasterize_segments(segments, (10, 10), LABELS, {GREEN: 1})[5, 5] == 1
+    # Equal priorities are drawn in order
+    assert rasterize_segments(segments, (10, 10), LABELS, {GREEN: 1, BLUE: 1})[5, 5] == 2
+
+@pytest.mark.parametrize('window', [(slice(2, 7), slice(3, 10)), (slice(0, 10), slice(0, 1)), (slice(8, 20), slice(-3, None))])
+def test_window_is_the_crop_of_the_full_matrix(window):
+    rng = np.random.default_rng(0)
+    segments = [(RED, FILL_THICKNESS, rng.random((6, 2)).tolist())]
+    segments += [(color, int(rng.integers(1, 4)), rng.random((4, 2)).tolist()) for color in (GREEN, BLUE, GREEN)]
+    full = rasterize_segments(segments, (10, 10), LABELS)
+    np.testing.assert_array_equal(rasterize_segments(segments, (10, 10), LABELS, window=window), full[window])
+
+def fill(polygons, keys, shape=(10, 10), rows=None, cols=None):
+    rows, cols = rows or slice(0, shape[0]), cols or slice(0, shape[1])
+    last_segment = np.full((rows.stop - rows.start) * (cols.stop - cols.start), -1, dtype=np.int32)
+    _fill_regions([np.asarray(polygon, dtype=np.float64) for polygon in polygons], keys, last_segment, rows, cols)
+    return last_segment.reshape(rows.stop - rows.start, cols.stop - cols.start)
+
+def test_fill_takes_the_pixels_whose_center_is_inside():
+    result = fill([[(1.5, 1.5), (5.5, 1.5), (5.5, 5.5), (1.5, 5.5)]], [3])
+    expected = np.full((10, 10), -1)
+    expected[2:6, 2:6] = 3
+    np.testing.assert_array_equal(result, expected)
+
+def test_fill_uses_the_even_odd_rule():
+    outer = [(0.5, 0.5), (8.5, 0.5), (8.5, 8.5), (0.5, 8.5), (0.5, 0.5)]
+    inner = [(2.5, 2.5), (2.5, 6.5), (6.5, 6.5), (6.5, 2.5), (2.5, 2.5)]
+    result = fill([outer + inner], [0])
+    assert (result[1:9, 1:9] == 0).sum() == 64 - 16
+    assert (result[3:7, 3:7] == -1).all()
+
+def test_fill_keeps_the_largest_key_and_the_window():
+    polygons = [[(1.5, 1.5), (5.5, 1.5), (5.5, 5.5), (1.5, 5.5)], [(3.5, 3.5), (7.5, 3.5), (7.5, 7.5), (3.5, 7.5)]]
+    full = fill(polygons, [2, 1])
+    assert full[4, 4] == 2 and full[6, 6] == 1
+    np.testing.assert_array_equal(fill(polygons, [2, 1], rows=slice(3, 9), cols=slice(5, 7)), full[3:9, 5:7])
+
+def test_fill_matches_point_in_polygon():
+    rng = np.random.default_rng(1)
+    polygon = rng.random((12, 2)) * 30
+    result = fill([polygon], [0], shape=(30, 30))
+    # A pixel center is inside when an odd number of edges cross its row at or before it
+    starts, ends = polygon, np.roll(polygon, -1, axis=0)
+    row, column = np.mgrid[0:30, 0:30]
+    crossings = np.zeros((30, 30), dtype=np.int64)
+    for (x0, y0), (x1, y1) in zip(starts, ends):
+        if y0 == y1:
+            continue
+        crosses = (np.minimum(y0, y1) <= row) & (row < np.maximum(y0, y1))
+        crossings += crosses & (x0 + (row - y0) * (x1 - x0) / (y1 - y0) <= column)
+    np.testing.assert_array_equal(result == 0, crossings % 2 == 1)